@@ -0,0 +1,314 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import queue
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional
+
+#######################################################################
+#Description    : Benchmarks the data paths of tao-runner (dataset check, label statistics, split, copy, convert)
+#                 on synthetic KITTI datasets. tao and ngc are replaced by stub executables.
+#Command:       : python3 scripts/benchmark.py --sizes 1000,100000 [--compare benchmark-<old>.json]
+#######################################################################
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, REPO_DIR.as_posix())
+kitti = importlib.import_module('tao-runner.kitti')
+split = importlib.import_module('tao-runner.tasks.split')
+convert = importlib.import_module('tao-runner.tasks.convert')
+stats = importlib.import_module('tao-runner.tasks.stats')
+fetch_models = importlib.import_module('tao-runner.tasks.fetch_models')
+ExperimentContext = importlib.import_module('tao-runner.context').ExperimentContext
+
+RESULTS_VERSION = 1
+
+# Smallest valid PNG (1x1 pixel, grayscale)
+DUMMY_PNG = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010800000000'
+                          '3a7e9b550000000a4944415478da63600000000200015e2d4e2e0000000049454e44ae426082')
+# Class name -> weight, so some classes are rare (for --stratified)
+CLASSES = {'Car': 60, 'Pedestrian': 25, 'Cyclist': 10, 'Truck': 4, 'Tram': 1}
+# Share of label files with 16 columns (e.g. exported with a score), without a label file and without objects
+OVERSIZED_SHARE = 0.02
+MISSING_LABEL_SHARE = 0.01
+BACKGROUND_SHARE = 0.02
+
+STUB_TAO = """#!/bin/sh
+# Stub of the tao launcher: succeeds without running a container
+echo "tao $1 $2"
+"""
+STUB_NGC = """#!/bin/sh
+# Stub of the ngc cli: creates an empty model in --dest
+mkdir -p "$5/model_v1" && touch "$5/model_v1/model.hdf5"
+"""
+
+PROJECT = 'benchmark'
+EXPERIMENT = 'benchmark'
+CONVERT_SPEC = """kitti_config {
+  root_directory_path: "$dataset/train"
+  image_dir_name: "image_2"
+  label_dir_name: "label_2"
+  image_extension: ".png"
+  partition_mode: "random"
+  num_partitions: 2
+  val_split: 0
+  num_shards: 10
+}
+image_directory_path: "$dataset/train"
+"""
+
+
+def label_rows(rng: random.Random) -> str:
+    """Realistic KITTI label rows, 16 columns for OVERSIZED_SHARE of the files."""
+    if rng.random() < BACKGROUND_SHARE:
+        return ''
+    oversized = rng.random() < OVERSIZED_SHARE
+    rows = []
+    for _ in range(rng.randint(1, 8)):
+        name = rng.choices(list(CLASSES), weights=list(CLASSES.values()))[0]
+        x, y = rng.uniform(0, 1000), rng.uniform(0, 300)
+        row = f"{name} 0.00 0 {rng.uniform(-3, 3):.2f} {x:.2f} {y:.2f} {x + rng.uniform(20, 200):.2f} {y + rng.uniform(20, 150):.2f} " + \
+            f"{rng.uniform(1, 3):.2f} {rng.uniform(1, 2):.2f} {rng.uniform(2, 5):.2f} {rng.uniform(-20, 20):.2f} " + \
+            f"{rng.uniform(1, 2):.2f} {rng.uniform(5, 80):.2f} {rng.uniform(-3, 3):.2f}"
+        rows.append(row + (f" {rng.random():.2f}" if oversized else ''))
+    return '\n'.join(rows) + '\n'
+
+
+def generate_dataset(kitti_dir: Path, images: int, seed: int = 0) -> Dict[str, Any]:
+    """Writes a synthetic KITTI dataset with 'images' dummy images and their labels."""
+    kitti.create_kitti_dir(kitti_dir)
+    images_dir, labels_dir = kitti_dir.joinpath('image_2'), kitti_dir.joinpath('label_2')
+
+    def write_chunk(start: int):
+        rng = random.Random(seed * 1_000_003 + start)
+        for i in range(start, min(start + 1000, images)):
+            name = f"{i:07d}"
+            images_dir.joinpath(name + '.png').write_bytes(DUMMY_PNG)
+            if rng.random() >= MISSING_LABEL_SHARE:
+                labels_dir.joinpath(name + '.txt').write_text(label_rows(rng))
+
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(write_chunk, range(0, images, 1000)))
+    return {'files': images}
+
+
+def write_stubs(bin_dir: Path):
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, script in (('tao', STUB_TAO), ('ngc', STUB_NGC)):
+        bin_dir.joinpath(name).write_text(script)
+        bin_dir.joinpath(name).chmod(0o755)
+
+
+def create_context(workdir: Path) -> ExperimentContext:
+    """Project 'benchmark' with a single experiment in 'workdir', which has to be the current directory."""
+    specs_dir = workdir.joinpath('projects', PROJECT, 'specs', EXPERIMENT)
+    specs_dir.mkdir(parents=True, exist_ok=True)
+    specs_dir.joinpath('convert.txt').write_text(CONVERT_SPEC)
+    config = {'head': 'dssd', 'backbone': 'resnet18', 'repository': 'pretrained_object_detection', 'model_key': 'key',
+              'dataset': 'synthetic', 'export_model': 'last', 'export_type': 'fp16'}
+    return ExperimentContext(PROJECT, EXPERIMENT, config, {'gpus': 1, 'gpu_indices': [0]})
+
+
+class FdSampler(threading.Thread):
+    """Samples the number of open file descriptors of the process (Linux only)."""
+
+    def __init__(self, interval: float = 0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak: Optional[int] = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.peak = max(self.peak or 0, len(os.listdir('/proc/self/fd')))
+            except FileNotFoundError:
+                return
+            if self._stopped.wait(self.interval):
+                return
+
+    def stop(self) -> Optional[int]:
+        self._stopped.set()
+        self.join()
+        return self.peak
+
+
+def measure(operation: Callable[[], Dict[str, Any]], verbose: bool, results) -> None:
+    """Runs in a forked child, so peak RSS and file descriptors are those of the operation alone."""
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    sampler = FdSampler()
+    sampler.start()
+    start = monotonic()
+    try:
+        counters = operation()
+        error = None
+    except BaseException as e:
+        counters, error = {}, f"{type(e).__name__}: {e}"
+    seconds = monotonic() - start
+    peak_fds = sampler.stop()
+    # KiB on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({'seconds': round(seconds, 4), 'peak_rss_mb': round(max_rss / (2**20 if sys.platform == 'darwin' else 2**10), 1),
+                 'peak_fds': peak_fds, 'error': error, **counters})
+
+
+def run_operation(name: str, operation: Callable[[], Dict[str, Any]], size: int, verbose: bool) -> Dict[str, Any]:
+    fork = get_context('fork')
+    results = fork.Queue()
+    process = fork.Process(target=measure, args=(operation, verbose, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1.0)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                # Killed, e.g. out of memory
+                result = {'seconds': 0.0, 'peak_rss_mb': 0.0, 'peak_fds': None,
+                          'error': f"Exited with code {process.exitcode}"}
+                break
+    process.join()
+
+    files = result.pop('files', None)
+    result = {'size': size, 'operation': name, **result, 'files': files,
+              'files_per_second': round(files / result['seconds']) if files and result['seconds'] > 0 else None}
+    print(f"{size:>9} {name:<24} {result['seconds']:>9.3f}s {result['files_per_second'] or '-':>10} files/s "
+          f"{result['peak_rss_mb']:>8.1f} MiB {result['peak_fds'] or '-':>5} fds" + (f"  {result['error']}" if result['error'] else ''))
+    return result
+
+
+def operations(workdir: Path, size: int, workers: Optional[int]) -> List[tuple]:
+    """(name, operation) in the order they run. Each operation returns counters, 'files' is used for the throughput."""
+    context = create_context(workdir)
+    full_dir = context.local_paths.dataset_dir.joinpath('full')
+
+    def check(rebuild: bool):
+        report = kitti.check_kitti(full_dir, rebuild_manifest=rebuild, workers=workers)
+        return {'files': len(report.images)}
+
+    def split_run(link_mode: str, **kwargs):
+        split.run(context, subset='full', overwrite=True, link_mode=link_mode, workers=workers, **kwargs)
+        # Image and label file of each sample, an index only lists each sample once
+        return {'files': size if kwargs.get('index_only') else 2 * size}
+
+    def stats_run(overwrite: bool):
+        stats.run(context, subsets='full', workers=workers, overwrite=overwrite)
+        return {'files': size}
+
+    def fetch_model():
+        index = fetch_models.ModelIndex(workdir.joinpath('repositories'))
+        fetch_models.fetch_model(index, 'pretrained_object_detection:resnet18', 'pretrained_object_detection', 'resnet18',
+                                 context.local_paths.pretrained_model_dir, force=True)
+        return {'files': 1}
+
+    def convert_run():
+        convert.run(context, overwrite=True)
+        return {'files': len(kitti.scan_dir(context.local_paths.subset_train_dir.joinpath('image_2'), kitti.IMAGE_EXTENSIONS))}
+
+    return [
+        ('generate', lambda: generate_dataset(full_dir, size)),
+        ('check_kitti.cold', lambda: check(True)),
+        ('check_kitti.warm', lambda: check(False)),
+        ('manifest_fingerprint', lambda: {'files': size} if kitti.manifest_fingerprint(full_dir, workers) else {}),
+        ('stats.cold', lambda: stats_run(True)),
+        ('stats.warm', lambda: stats_run(False)),
+        ('split.copy', lambda: split_run('copy')),
+        ('split.hardlink', lambda: split_run('hardlink', seed=1)),
+        ('split.symlink', lambda: split_run('symlink', seed=2)),
+        ('convert', convert_run),
+        ('fetch_models', fetch_model),
+        # Last: an index-only split removes the train / val subsets the conversion reads
+        ('split.stratified.index', lambda: split_run('copy', seed=3, stratified=True, index_only=True)),
+    ]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict[str, Any]], baseline_file: Path):
+    """Prints the time of each operation relative to a previous run."""
+    baseline = {(result['size'], result['operation']): result
+                for result in json.loads(baseline_file.read_text())['results']}
+    print(f"\nCompared to {baseline_file} (time / baseline time, < 1 is faster):")
+    for result in results:
+        old = baseline.get((result['size'], result['operation']))
+        if old is None or result['error'] or old['error']:
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] > 0 else float('inf')
+        print(f"{result['size']:>9} {result['operation']:<24} {old['seconds']:>9.3f}s -> {result['seconds']:>9.3f}s  x{ratio:.2f}"
+              f"  rss {old['peak_rss_mb']:.1f} -> {result['peak_rss_mb']:.1f} MiB")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks the data paths of tao-runner on synthetic KITTI datasets')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='Comma separated number of images of the synthetic datasets (e.g. 1000,100000,1000000)')
+    parser.add_argument('--workers', type=int, help='Threads of the checks and copies (default: tao-runner default)')
+    parser.add_argument('--workdir', type=Path, help='Directory of the datasets (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='Keep the datasets after the run')
+    parser.add_argument('--output', type=Path, help='Results file (default: benchmark-<git revision>-<timestamp>.json)')
+    parser.add_argument('--compare', type=Path, help='Results file of a previous run to compare with')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of tao-runner')
+    args = parser.parse_args()
+
+    # Relative to the directory the benchmark was started in, not the working directories of the runs
+    revision = git_revision()
+    output = (args.output or Path(f"benchmark-{revision or 'unknown'}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")).resolve()
+    compare_file = args.compare.resolve() if args.compare else None
+    original_cwd = Path.cwd()
+
+    workdir = args.workdir.resolve() if args.workdir else Path(tempfile.mkdtemp(prefix='tao-runner-benchmark-'))
+    write_stubs(workdir.joinpath('bin'))
+    os.environ['PATH'] = workdir.joinpath('bin').as_posix() + os.pathsep + os.environ['PATH']
+
+    results = []
+    print(f"{'images':>9} {'operation':<24} {'time':>10} {'throughput':>16} {'peak rss':>12} {'fds':>5}")
+    try:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            size_dir = workdir.joinpath(str(size))
+            if size_dir.exists():
+                shutil.rmtree(size_dir)
+            size_dir.mkdir(parents=True)
+            # tao-runner works relative to the current directory
+            os.chdir(size_dir)
+            for name, operation in operations(size_dir, size, args.workers):
+                results.append(run_operation(name, operation, size, args.verbose))
+            os.chdir(workdir)
+            if not args.keep:
+                shutil.rmtree(size_dir)
+    finally:
+        os.chdir(original_cwd)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output.write_text(json.dumps({
+        'version': RESULTS_VERSION, 'revision': revision, 'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+        'workers': args.workers, 'results': results}, indent=2))
+    print(f"Results written to {output}")
+
+    if compare_file:
+        compare(results, compare_file)
+    return 0 if all(result['error'] is None for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
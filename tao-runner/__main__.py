@@ -1,40 +1,107 @@
+import sqlite3
+import sys
+from datetime import datetime, timedelta
 from os import environ
 from pathlib import Path
 from shutil import copyfile
+from time import monotonic
+from typing import Any, Dict, Optional
 
-from .context import ExperimentContext
+from .context import ExperimentContext, TaoConfig
 from .parsers.argument_parser import Parser as ArgParser
 from .parsers.project_parser import Parser as ProjParser
+from .process import tao_exit_code
+from .runs import RunDatabase, final_metrics
+from .scheduler import Job, Scheduler
+from .trace import span, start_trace, stop_trace
 from . import tasks
 
 
+def record_job(db: RunDatabase, command: str, args: Dict[str, Any], job: Job):
+    """Adds a finished job to the run database, with the outputs of its task and the metrics of the training log.
+    Pipeline stages that were up to date did not run and are not recorded."""
+    if job.status == 'up-to-date':
+        return
+    task_name = job.task_name or command
+    task = tasks.known_tasks.get(task_name)
+    ran = job.status in ('done', 'failed') and job.started is not None
+    seconds = (job.finished or monotonic()) - job.started if ran else None
+    started = datetime.now() - timedelta(seconds=seconds or 0)
+
+    # Called in the thread of the job, which collected the exit codes of its tao processes
+    exit_code = tao_exit_code() if ran else None
+    artifacts = []
+    if job.status == 'done' and hasattr(task, 'outputs'):
+        artifacts = [output.relative_to(Path.cwd()) for output in task.outputs(job.context, **args) if output.exists()]
+    metrics = None
+    if ran and getattr(task, 'records_metrics', False) and job.context.local_paths.model_dir.joinpath("train.log").is_file():
+        metrics = final_metrics(tasks.metrics.metrics_log(job.context))
+    db.record(command, task_name, job.context, started, seconds, job.status, exit_code, job.error, artifacts, metrics,
+              spec_template=getattr(task, 'spec_template', None))
+
+
 def main() -> int:
     args = ArgParser().parse()
-    project = ProjParser().parse(args.project)
+    assert args.command in tasks.known_tasks, f"Unknown task '{args.command}'"
+    command = tasks.known_tasks[args.command]
+    if hasattr(command, 'query'):
+        # Answered from the run database, no project is loaded
+        return 0 if command.query(RunDatabase(), **vars(args)) else 1
+
+    project_parser = ProjParser()
+    project = project_parser.parse(args.project)
+    # All experiments are checked before the first one starts
+    experiments = args.experiments or list((project or {}).get('experiments') or [])
+    project_parser.validate(project, experiments)
+    assert experiments, f"The project '{args.project}' has no experiments"
 
     # TAO uses ~/.tao_mounts.json, so copying the file there...
-    copyfile(Path('.tao_mounts.json'),
-             Path.home().joinpath('.tao_mounts.json'))
+    mounts_file = Path.home().joinpath('.tao_mounts.json')
+    if not mounts_file.is_file() or mounts_file.read_bytes() != Path('.tao_mounts.json').read_bytes():
+        copyfile(Path('.tao_mounts.json'), mounts_file)
 
     # Temporary fix for the TAO Docker Image using WSL 2.
     # https://forums.developer.nvidia.com/t/wsl2-tao-issues/195476
     environ['OVERRIDE_REGISTRY'] = 'local.pwn'
 
-    assert args.command in tasks.known_tasks, f"Unknown task '{args.command}'"
-    command = tasks.known_tasks[args.command]
-
     print(f"Running task '{args.command}' on project '{args.project}'")
 
-    for experiment in args.experiments:
-        print(f"Experiment: {experiment}")
-        tao_config = project['tao_config']
+    tao_config = TaoConfig(project['tao_config'])
+    contexts = []
+    for experiment in experiments:
         experiment_config = project['experiments'][experiment]
-        context = ExperimentContext(
-            project=args.project, experiment=experiment, config=experiment_config, tao=tao_config)
-        command.run(context, **vars(args))
+        contexts.append(ExperimentContext(
+            project=args.project, experiment=experiment, config=experiment_config, tao=project['tao_config']))
+
+    if hasattr(command, 'setup'):
+        command.setup(**vars(args))
+
+    # Every job is recorded in the run database of the workspace (see 'status' and 'history')
+    try:
+        db: Optional[RunDatabase] = RunDatabase()
+        db.update_experiments(contexts, project['experiments'])
+    except sqlite3.Error as e:
+        print(f"Warning: runs are not recorded, the run database cannot be opened: {e}")
+        db = None
+    scheduler = Scheduler(tao_config.available_gpu_indices, tao_config.gpu_count, cpu_jobs=getattr(args, 'jobs', 2),
+                          on_finished=(lambda job: record_job(db, args.command, vars(args), job)) if db else None)
+
+    # Timings of the invocation (one JSON record per span, see trace.span)
+    tracer = start_trace(contexts[0].local_paths.project_dir.joinpath('.tao-runner', 'traces'), args.command, args.profile)
+    try:
+        with span('command', command=args.command, experiments=[context.experiment for context in contexts]):
+            if hasattr(command, 'run_all'):
+                succeeded = command.run_all(contexts, scheduler, **vars(args))
+            else:
+                succeeded = scheduler.run_task(contexts, lambda context: command.run(
+                    context, **vars(args)), uses_gpu=getattr(command, 'uses_gpu', False),
+                    modifies_dataset=getattr(command, 'modifies_dataset', False))
+    finally:
+        stop_trace()
+    print(f"Trace written to {tracer.file}")
 
-    return 0
+    return 0 if succeeded else 1
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from shutil import rmtree
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .fileutils import fcntl, write_atomic
+
+# Written into an entry once it is complete
+ENTRY_FILENAME = '.cache.json'
+
+
+def dir_size(directory: Path) -> int:
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+class OutputCache:
+    """Content-addressed directories of task outputs, shared by all experiments with the same inputs.
+
+    Each entry is a directory '<cache_dir>/<key>', where the key is a hash of the inputs. Experiments link to the
+    entry via a relative symlink, which also resolves inside the tao container. Entries no experiment links to are
+    removed by collect(), least recently used first."""
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+
+    def entry_dir(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key)
+
+    def lock_file(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key + '.lock')
+
+    @contextmanager
+    def lock(self, key: str, shared: bool = False, blocking: bool = True) -> Iterator[bool]:
+        """Locks an entry via '<cache_dir>/<key>.lock' (flock), across threads and processes.
+
+        Readers of an entry hold a shared lock, creating or removing it requires the exclusive lock.
+        Yields whether the lock was acquired (always True if 'blocking')."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        while True:
+            with open(self.lock_file(key), 'a') as lock_file:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+                    except BlockingIOError:
+                        yield False
+                        return
+                    # The lock file was removed with its entry while waiting (see _remove): lock the new one
+                    try:
+                        if os.stat(self.lock_file(key)).st_ino != os.fstat(lock_file.fileno()).st_ino:
+                            continue
+                    except FileNotFoundError:
+                        continue
+                # Closing the file releases the lock
+                yield True
+                return
+
+    def info(self, key: str) -> Optional[Dict[str, Any]]:
+        """The info of a complete entry, None if the entry does not exist or is incomplete."""
+        try:
+            return json.loads(self.entry_dir(key).joinpath(ENTRY_FILENAME).read_bytes())
+        except (OSError, ValueError):
+            return None
+
+    def prepare(self, key: str) -> Path:
+        """An empty directory for a new entry. Remains incomplete until complete() is called."""
+        entry_dir = self.entry_dir(key)
+        if entry_dir.exists():
+            rmtree(entry_dir)
+        entry_dir.mkdir(parents=True)
+        return entry_dir
+
+    def complete(self, key: str, **info: Any):
+        entry_dir = self.entry_dir(key)
+        now = datetime.now().isoformat(timespec='seconds')
+        write_atomic(entry_dir.joinpath(ENTRY_FILENAME), json.dumps(
+            {**info, 'size': dir_size(entry_dir), 'created': now, 'last_used': now}, indent=2))
+
+    def touch(self, key: str):
+        """Marks the entry as used now, which keeps it from being collected first. Best effort, as other readers
+        of the entry may touch it at the same time."""
+        info = self.info(key)
+        if info is not None:
+            info['last_used'] = datetime.now().isoformat(timespec='seconds')
+            try:
+                write_atomic(self.entry_dir(key).joinpath(ENTRY_FILENAME), json.dumps(info, indent=2))
+            except OSError:
+                pass
+
+    def linked_key(self, link: Path) -> Optional[str]:
+        """The key of the entry 'link' points to, None if it is no link into the cache."""
+        if not link.is_symlink():
+            return None
+        target = Path(os.path.normpath(link.parent.joinpath(os.readlink(link))))
+        return target.name if target.parent == Path(os.path.normpath(self.cache_dir)) else None
+
+    def link(self, link: Path, key: str):
+        """Points 'link' to the entry (replacing an existing link atomically)."""
+        tmp_link = link.with_name(f".{link.name}.tmp")
+        if tmp_link.is_symlink():
+            tmp_link.unlink()
+        os.symlink(os.path.relpath(self.entry_dir(key), link.parent), tmp_link)
+        os.replace(tmp_link, link)
+
+    def collect(self, budget: int, in_use: List[str]) -> Tuple[int, int]:
+        """Removes incomplete entries and, while the cache is larger than 'budget' bytes, the least recently used
+        entries that are not in use. Entries locked by a running task (being created or read) are skipped.
+        Returns the number of removed entries and their size."""
+        entries = []
+        removed, freed = 0, 0
+        try:
+            names = [(entry.name, entry.is_dir()) for entry in os.scandir(self.cache_dir)]
+        except FileNotFoundError:
+            return 0, 0
+        keys = [name for name, is_dir in names if is_dir]
+        # Lock files whose entry is gone (e.g. removed by hand) are not entries, only cleaned up
+        for name, is_dir in names:
+            if not is_dir and name.endswith('.lock') and name[:-len('.lock')] not in keys:
+                self._remove(name[:-len('.lock')])
+        for key in keys:
+            info = self.info(key)
+            if info is None and key not in in_use:
+                size = self._remove(key)
+                if size is not None:
+                    freed += size
+                    removed += 1
+            elif info is not None:
+                entries.append((info['last_used'], key, info['size']))
+
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= budget:
+                break
+            if key not in in_use and self._remove(key) is not None:
+                total -= size
+                freed += size
+                removed += 1
+        return removed, freed
+
+    def _remove(self, key: str) -> Optional[int]:
+        """Removes an entry and its lock file, unless another task holds its lock. Returns its size, None if it was
+        not removed."""
+        with self.lock(key, blocking=False) as locked:
+            if not locked:
+                return None
+            size = dir_size(self.entry_dir(key))
+            rmtree(self.entry_dir(key), ignore_errors=True)
+            # Still locked: tasks waiting for the old lock file lock the new one instead (see lock)
+            self.lock_file(key).unlink(missing_ok=True)
+        return size
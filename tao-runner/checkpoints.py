@@ -0,0 +1,121 @@
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from .fileutils import write_atomic
+from .train_log import MetricsLog
+
+INDEX_VERSION = 1
+
+# Checkpoints written by tao train, e.g. 'dssd_resnet18_epoch_080.tlt'
+CHECKPOINT_PATTERN = re.compile(r'epoch_(\d+)\.tlt$')
+# 'best', 'last' or 'top-<k>', optionally ranked by another metric than mAP, e.g. 'best:loss'
+SELECTOR_PATTERN = re.compile(r'^(best|last|top-(\d+))(?::(\w+))?$')
+# Metrics where a lower value is better, all others are maximized
+LOWER_IS_BETTER = {'loss'}
+
+
+def is_selector(name: str) -> bool:
+    return SELECTOR_PATTERN.match(name) is not None
+
+
+class Checkpoint:
+    def __init__(self, name: str, epoch: int, size: int, metrics: Dict[str, float]):
+        # Filename without '.tlt', as used for export_model
+        self.name = name
+        self.epoch = epoch
+        self.size = size
+        self.metrics = metrics
+
+
+class CheckpointIndex:
+    """The checkpoints in a weights dir, joined with the metrics of their epoch parsed from the train.log.
+
+    The checkpoints (epoch, size, mtime) are stored in 'index_file', so updates only stat the weights dir and
+    parse the lines appended to the log since the last update."""
+
+    def __init__(self, weights_dir: Path, index_file: Path, metrics_log: MetricsLog):
+        self.weights_dir = weights_dir
+        self.index_file = index_file
+        self.metrics_log = metrics_log
+        # Filename -> (epoch, size, mtime_ns)
+        self.entries: Dict[str, Tuple[int, int, int]] = {}
+        try:
+            index = json.loads(index_file.read_bytes())
+            if index.get('version') == INDEX_VERSION:
+                self.entries = {name: tuple(entry) for name, entry in index['checkpoints'].items()}
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        write_atomic(self.index_file, json.dumps(
+            {'version': INDEX_VERSION, 'checkpoints': self.entries}, indent=2, sort_keys=True))
+
+    def update(self) -> List[Checkpoint]:
+        """Indexes new checkpoints and epochs. Returns all checkpoints, ordered by epoch."""
+        entries = {}
+        try:
+            with os.scandir(self.weights_dir) as scan:
+                for entry in scan:
+                    match = CHECKPOINT_PATTERN.search(entry.name)
+                    if match and entry.is_file():
+                        st = entry.stat()
+                        entries[entry.name] = (int(match.group(1)), st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        if entries != self.entries:
+            self.entries = entries
+            self._save()
+
+        if self.metrics_log.log_file.is_file():
+            self.metrics_log.update()
+        return [Checkpoint(name[:-len('.tlt')], epoch, size, self.metrics_log.epochs.get(epoch, {}))
+                for name, (epoch, size, _) in sorted(self.entries.items(), key=lambda item: item[1][0])]
+
+    def select(self, selector: str) -> List[Checkpoint]:
+        """The checkpoints chosen by a selector (see SELECTOR_PATTERN). Checkpoints of epochs without a value
+        for the metric are not ranked; ties are won by the later epoch."""
+        match = SELECTOR_PATTERN.match(selector)
+        assert match, f"Invalid checkpoint selector '{selector}'. Use 'best', 'last' or 'top-<k>', optionally followed by ':<metric>'"
+        checkpoints = self.update()
+        if match.group(1) == 'last':
+            return checkpoints[-1:]
+
+        metric = match.group(3) or 'mAP'
+        assert metric in self.metrics_log.metrics, \
+            f"Unknown metric '{metric}'. Available: {', '.join(self.metrics_log.metrics)}"
+        ranked = [checkpoint for checkpoint in checkpoints if checkpoint.metrics.get(metric) is not None]
+        sign = -1 if metric in LOWER_IS_BETTER else 1
+        ranked.sort(key=lambda checkpoint: (sign * checkpoint.metrics[metric], checkpoint.epoch), reverse=True)
+        return ranked[:int(match.group(2) or 1)]
+
+    def prune(self, keep: List[Checkpoint]) -> Tuple[int, int]:
+        """Deletes all checkpoints except 'keep' and the last one (to resume training).
+        Returns the number of deleted checkpoints and their size."""
+        checkpoints = self.update()
+        keep_names = {checkpoint.name for checkpoint in keep + checkpoints[-1:]}
+        deleted, size = 0, 0
+        for checkpoint in checkpoints:
+            if checkpoint.name not in keep_names:
+                os.remove(self.weights_dir.joinpath(checkpoint.name + '.tlt'))
+                del self.entries[checkpoint.name + '.tlt']
+                deleted += 1
+                size += checkpoint.size
+        if deleted:
+            self._save()
+        return deleted, size
+
+
+def select_checkpoints(index: CheckpointIndex, names: List[str]) -> List[str]:
+    """Replaces the selectors in a list of checkpoint names by the names of the selected checkpoints."""
+    resolved: List[str] = []
+    for name in names:
+        if is_selector(name):
+            selected = index.select(name)
+            assert selected, f"No checkpoint matches '{name}' in {index.weights_dir}"
+            resolved += [checkpoint.name for checkpoint in selected]
+        else:
+            resolved.append(name)
+    return list(dict.fromkeys(resolved))
@@ -1,12 +1,30 @@
+import os
+from functools import cached_property
 from pathlib import Path
-from typing import Any, Dict, Optional
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+# Spec templates in specs/<experiment>
+CONVERT_SPEC = 'convert.txt'
+TRAIN_SPEC = 'train.txt'
 
 
 class TaoConfig:
     def __init__(self, config: Dict[str, Any]):
+        self.gpu_count = int(config['gpus'])
+        self.available_gpu_indices: List[int] = [int(i) for i in config['gpu_indices']]
         self.gpus = str(config['gpus'])
         self.gpu_indices = ','.join([str(i) for i in config['gpu_indices']])
 
+    def assign_gpus(self, indices: List[int]):
+        """Restricts the experiment to a slice of the available gpus."""
+        self.gpus = str(len(indices))
+        self.gpu_indices = ','.join([str(i) for i in indices])
+
+
+def as_list(value: Any) -> List[str]:
+    return [str(item) for item in value] if isinstance(value, list) else [str(value)]
+
 
 class ExperimentConfig:
     def __init__(self, config: Dict[str, Any]):
@@ -15,41 +33,144 @@ class ExperimentConfig:
         self.repository: str = config['repository']
         self.model_key: str = config['model_key']
         self.dataset: str = config['dataset']
-        self.export_model: str = config['export_model']
-        self.export_type: str = config['export_type']
+        # The models (.tlt files) to export and the data types to export them with, each a single value or a list
+        self.export_models: List[str] = as_list(config['export_model'])
+        self.export_types: List[str] = as_list(config['export_type'])
+
+
+# Per-process cache of directory listings (e.g. of the shared repositories dir), see list_dir
+_listings: Dict[Path, Tuple[str, ...]] = {}
+_listings_lock = Lock()
+
+
+def list_dir(directory: Path) -> Tuple[str, ...]:
+    """Sorted names of the entries in a directory (empty if it does not exist). Each existing directory is only listed
+    once, until forget_dir is called for it; missing ones are looked up again, as a later task may create them."""
+    with _listings_lock:
+        listing = _listings.get(directory)
+    if listing is None:
+        try:
+            listing = tuple(sorted(os.listdir(directory)))
+        except FileNotFoundError:
+            return ()
+        with _listings_lock:
+            _listings[directory] = listing
+    return listing
+
+
+def forget_dir(directory: Path):
+    """Drops the cached listing of a directory, after its entries were changed."""
+    with _listings_lock:
+        _listings.pop(directory, None)
 
 
 class ExperimentPaths:
-    def __init__(self, base: Path, project: str, experiment: str, config: ExperimentConfig, pretrained_model_filename: Optional[str] = None):
-        # Base dirs
-        self.project_dir = base.joinpath('projects', project)
-        data_dir = self.project_dir.joinpath('data')
-        models_dir = self.project_dir.joinpath('models')
-        specs_dir = self.project_dir.joinpath('specs')
-
-        # Specialised dirs
-        self.model_dir = models_dir.joinpath(experiment)
-
-        self.specs_dir = specs_dir.joinpath(experiment)
-
-        self.dataset_dir = data_dir.joinpath(config.dataset)
-        self.subset_full_dir = self.dataset_dir.joinpath("full")
-        self.subset_train_dir = self.dataset_dir.joinpath("train")
-        self.subset_val_dir = self.dataset_dir.joinpath("val")
-        self.subset_tfrecords_dir = self.dataset_dir.joinpath(
-            "tfrecords_" + experiment)
-        self.pretrained_model_dir = base.joinpath(
-            'repositories', config.repository, config.repository + '_v' + config.backbone)
-
-        # Files
-        self.convert_spec_file = self.specs_dir.joinpath('convert.txt')
-        self.train_spec_file = self.specs_dir.joinpath('train.txt')
-        self.compiled_convert_spec_file = self.subset_tfrecords_dir.joinpath(
-            self.convert_spec_file.name)
-        self.compiled_train_spec_file = self.model_dir.joinpath(
-            self.convert_spec_file.name)
-        self.pretrained_model_file = self.pretrained_model_dir.joinpath(pretrained_model_filename) if pretrained_model_filename else next(
-            self.pretrained_model_dir.glob('*.hdf5'), None)
+    """Paths of an experiment below 'base'. All paths are computed on first access.
+
+    The pretrained model file is looked up in 'pretrained_model_lookup_dir' (defaults to the own pretrained_model_dir),
+    so the docker side paths can use the file found on the local side."""
+
+    def __init__(self, base: Path, project: str, experiment: str, config: ExperimentConfig, pretrained_model_lookup_dir: Optional[Path] = None):
+        self.base = base
+        self.project = project
+        self.experiment = experiment
+        self.config = config
+        self._pretrained_model_lookup_dir = pretrained_model_lookup_dir
+
+    # Base dirs
+    @cached_property
+    def project_dir(self) -> Path:
+        return self.base.joinpath('projects', self.project)
+
+    @cached_property
+    def model_dir(self) -> Path:
+        return self.project_dir.joinpath('models', self.experiment)
+
+    @cached_property
+    def specs_dir(self) -> Path:
+        return self.project_dir.joinpath('specs', self.experiment)
+
+    @cached_property
+    def state_dir(self) -> Path:
+        """State of tao-runner itself (e.g. pipeline stamps)"""
+        return self.project_dir.joinpath('.tao-runner', self.experiment)
+
+    # Dataset
+    @cached_property
+    def dataset_dir(self) -> Path:
+        return self.project_dir.joinpath('data', self.config.dataset)
+
+    @cached_property
+    def subset_full_dir(self) -> Path:
+        return self.dataset_dir.joinpath("full")
+
+    @cached_property
+    def subset_train_dir(self) -> Path:
+        return self.dataset_dir.joinpath("train")
+
+    @cached_property
+    def subset_val_dir(self) -> Path:
+        return self.dataset_dir.joinpath("val")
+
+    @cached_property
+    def subset_tfrecords_dir(self) -> Path:
+        return self.dataset_dir.joinpath("tfrecords_" + self.experiment)
+
+    @cached_property
+    def tfrecords_cache_dir(self) -> Path:
+        """Converted tfrecords shared by the experiments (tfrecords_<experiment> links into it)"""
+        return self.dataset_dir.joinpath(".tfrecords_cache")
+
+    @cached_property
+    def split_train_file(self) -> Path:
+        return self.dataset_dir.joinpath("train.txt")
+
+    @cached_property
+    def split_val_file(self) -> Path:
+        return self.dataset_dir.joinpath("val.txt")
+
+    @cached_property
+    def split_info_file(self) -> Path:
+        return self.dataset_dir.joinpath("split.json")
+
+    # Specs
+    @cached_property
+    def convert_spec_file(self) -> Path:
+        return self.specs_dir.joinpath(CONVERT_SPEC)
+
+    @cached_property
+    def train_spec_file(self) -> Path:
+        return self.specs_dir.joinpath(TRAIN_SPEC)
+
+    @cached_property
+    def compiled_convert_spec_file(self) -> Path:
+        return self.subset_tfrecords_dir.joinpath(self.convert_spec_file.name)
+
+    @cached_property
+    def compiled_train_spec_file(self) -> Path:
+        return self.model_dir.joinpath(self.train_spec_file.name)
+
+    # Pretrained model
+    @cached_property
+    def pretrained_model_dir(self) -> Path:
+        return self.base.joinpath('repositories', self.config.repository, self.config.repository + '_v' + self.config.backbone)
+
+    @cached_property
+    def pretrained_model_filename(self) -> Optional[str]:
+        lookup_dir = self._pretrained_model_lookup_dir or self.pretrained_model_dir
+        return next((name for name in list_dir(lookup_dir) if name.endswith('.hdf5')), None)
+
+    @property
+    def has_pretrained_model(self) -> bool:
+        return self.pretrained_model_filename is not None
+
+    @property
+    def pretrained_model_file(self) -> Path:
+        """The pretrained weights (.hdf5). Fails if there are none."""
+        assert self.pretrained_model_filename is not None, \
+            f"No pretrained model (*.hdf5) found in '{self._pretrained_model_lookup_dir or self.pretrained_model_dir}'. " + \
+            "Download it first with 'python -m tao-runner fetch-models'"
+        return self.pretrained_model_dir.joinpath(self.pretrained_model_filename)
 
 
 class ExperimentContext:
@@ -58,7 +179,12 @@ class ExperimentContext:
         self.experiment = experiment
         self.tao = TaoConfig(tao)
         self.config = ExperimentConfig(config)
-        self.local_paths = ExperimentPaths(
-            project=project, experiment=experiment, config=self.config, base=Path.cwd())
-        self.docker_paths = ExperimentPaths(
-            project=project, experiment=experiment, config=self.config, base=Path('/workspace'), pretrained_model_filename=self.local_paths.pretrained_model_file.name)
+
+    @cached_property
+    def local_paths(self) -> ExperimentPaths:
+        return ExperimentPaths(project=self.project, experiment=self.experiment, config=self.config, base=Path.cwd())
+
+    @cached_property
+    def docker_paths(self) -> ExperimentPaths:
+        return ExperimentPaths(project=self.project, experiment=self.experiment, config=self.config, base=Path('/workspace'),
+                               pretrained_model_lookup_dir=self.local_paths.pretrained_model_dir)
@@ -0,0 +1,200 @@
+import errno
+import hashlib
+import os
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from pathlib import Path
+from shutil import copyfile
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Tuple, Union
+
+from .trace import span
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def write_atomic(file: Path, content: Union[str, bytes]):
+    """Writes the file via a temporary sibling, so readers never see a partially written file."""
+    tmp_file = file.with_name(f".{file.name}.tmp")
+    with open(tmp_file, 'wb' if isinstance(content, bytes) else 'w') as w:
+        w.write(content)
+    os.replace(tmp_file, file)
+
+
+def hash_file(file: Path, chunk_size: int = 1 << 20) -> str:
+    """Content hash of a file, read in chunks."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as r:
+        for chunk in iter(lambda: r.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'symlink')
+
+# ioctl request to share the extents of a file (btrfs, xfs, ...), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# Errors signaling that the filesystem cannot link the file with the requested mode
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP,
+                       errno.ENOTSUP, errno.EINVAL, errno.ENOTTY, errno.EMLINK, errno.ENOSYS}
+
+
+def reflink(src: Path, dest: Path):
+    """Creates a copy-on-write clone of 'src' at 'dest'."""
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "Reflinks are not supported on this platform", str(dest))
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dest)
+            raise
+
+
+class FileMaterializer:
+    """Places files at a new location by copying or linking them.
+
+    If the filesystem does not support the link mode, it falls back to copying for all remaining files.
+    Symlinks are created relative and only if source and destination lie inside 'root' (the directory mounted into
+    the tao container), so they resolve on the host and in the container alike. Otherwise it falls back to copying.
+    """
+
+    def __init__(self, mode: str = 'copy', root: Optional[Path] = None):
+        assert mode in LINK_MODES, f"Unknown link mode '{mode}'. Use one of {', '.join(LINK_MODES)}"
+        self.requested_mode = mode
+        self.mode = mode
+        self.root = os.path.realpath(root) if root else None
+        self._lock = Lock()
+        self._dir_cache: Dict[str, str] = {}
+
+    def __call__(self, src: Path, dest: Path) -> str:
+        """Materializes 'src' at 'dest'. Returns the mode that was actually used."""
+        mode = self.mode
+        try:
+            if mode == 'hardlink':
+                os.link(src, dest)
+            elif mode == 'reflink':
+                reflink(src, dest)
+            elif mode == 'symlink':
+                target = self._symlink_target(src, dest)
+                if target is None:
+                    self._fall_back(
+                        mode, f"{src} is outside of the mounted directory {self.root}")
+                    copyfile(src, dest)
+                    return 'copy'
+                os.symlink(target, dest)
+            else:
+                copyfile(src, dest)
+            return mode
+        except OSError as e:
+            if mode == 'copy' or e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            self._fall_back(mode, e.strerror)
+            copyfile(src, dest)
+            return 'copy'
+
+    def _fall_back(self, mode: str, reason: str):
+        with self._lock:
+            if self.mode == mode:
+                print(
+                    f"Link mode '{mode}' is not supported here ({reason}). Copying files instead.")
+                self.mode = 'copy'
+
+    def _realdir(self, directory: str) -> str:
+        real = self._dir_cache.get(directory)
+        if real is None:
+            real = self._dir_cache[directory] = os.path.realpath(directory)
+        return real
+
+    def _inside_root(self, path: str) -> bool:
+        return self.root is None or path == self.root or path.startswith(self.root + os.sep)
+
+    def _symlink_target(self, src: Path, dest: Path) -> Optional[str]:
+        src_dir, src_name = os.path.split(src)
+        real_src = os.path.join(self._realdir(src_dir), src_name)
+        if os.path.islink(real_src):
+            real_src = os.path.realpath(real_src)
+        real_dest_dir = self._realdir(os.path.dirname(dest))
+        if not self._inside_root(real_src) or not self._inside_root(real_dest_dir):
+            return None
+        return os.path.relpath(real_src, real_dest_dir)
+
+
+class MaterializeResult:
+    def __init__(self):
+        # Mode -> number of files
+        self.modes: Counter = Counter()
+        self.bytes_copied = 0
+        # Destination -> error message
+        self.errors: Dict[Path, str] = {}
+        self.seconds = 0.0
+
+    @property
+    def files(self) -> int:
+        return sum(self.modes.values())
+
+    def summary(self) -> str:
+        lines = [', '.join(f"{mode}: {count} files" for mode, count in self.modes.items()) +
+                 f" in {self.seconds:.1f}s ({_throughput(self.files, self.bytes_copied, self.seconds)})"]
+        for dest, error in sorted(self.errors.items()):
+            lines.append(f"Failed to create {dest}: {error}")
+        return '\n'.join(lines)
+
+
+def _throughput(files: int, bytes_copied: int, seconds: float) -> str:
+    seconds = max(seconds, 1e-6)
+    return f"{files / seconds:.0f} files/s, {bytes_copied / seconds / 2**20:.1f} MiB/s"
+
+
+def materialize_files(pairs: List[Tuple[Path, Path]], materialize: Optional[FileMaterializer] = None,
+                      workers: Optional[int] = None, progress_interval: float = 2.0) -> MaterializeResult:
+    """Copies (or links) each (source, destination) pair on a bounded thread pool.
+
+    The destination directories have to exist. Errors are collected instead of stopping at the first failing file.
+    """
+    materialize = materialize or FileMaterializer()
+    result = MaterializeResult()
+    start = last_report = monotonic()
+
+    def place(pair: Tuple[Path, Path]) -> Tuple[Path, Optional[str], int, Optional[str]]:
+        src, dest = pair
+        try:
+            mode = materialize(src, dest)
+            return dest, mode, os.path.getsize(src) if mode == 'copy' else 0, None
+        except OSError as e:
+            return dest, None, 0, str(e)
+
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    with span('materialize', mode=materialize.requested_mode, workers=workers) as counters, ThreadPoolExecutor(max_workers=workers) as executor:
+        # Submit a bounded window of work, so memory does not grow with the number of files
+        window = 4 * workers
+        pending = iter(pairs)
+        futures = {executor.submit(place, pair)
+                   for pair in islice(pending, window)}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                dest, mode, size, error = future.result()
+                if error is not None:
+                    result.errors[dest] = error
+                else:
+                    result.modes[mode] += 1
+                    result.bytes_copied += size
+            futures |= {executor.submit(place, pair)
+                        for pair in islice(pending, len(done))}
+
+            now = monotonic()
+            if now - last_report >= progress_interval:
+                last_report = now
+                print(f"{result.files}/{len(pairs)} files ({_throughput(result.files, result.bytes_copied, now - start)})")
+        counters.update(files=result.files, bytes=result.bytes_copied, errors=len(result.errors))
+
+    result.seconds = monotonic() - start
+    return result
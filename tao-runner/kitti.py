@@ -0,0 +1,234 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .fileutils import write_atomic
+from .manifest import Manifest, ManifestEntry
+from .trace import span
+
+
+# Datumaro does not export label files for 'background' images, which do not contain any object to be detected.
+# TAO expects kitti label files to have 15 columns, but kitti has 16 originally (https://github.com/NVIDIA/DIGITS/issues/992)
+
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg')
+LABEL_EXTENSION = '.txt'
+KITTI_COLUMNS = 15
+
+
+class KittiReport:
+    """Result of validating (and fixing) a KITTI directory."""
+
+    def __init__(self, kitti_dir: Path, images: Dict[str, Path], labels: Dict[str, Path], fixed: bool = True):
+        self.kitti_dir = kitti_dir
+        self.fixed = fixed
+        self.images = images
+        self.labels = labels
+        # Stems of images without a label file (an empty one is created if fixing is enabled)
+        self.missing_labels: List[str] = []
+        # Stems of label files without a matching image
+        self.orphan_labels: List[str] = sorted(
+            stem for stem in labels if stem not in images)
+        # Label file name -> number of rows cut down to KITTI_COLUMNS fields
+        self.truncated: Dict[str, int] = {}
+        # Label file name -> error message
+        self.errors: Dict[str, str] = {}
+        # Samples skipped, because they did not change since the last check
+        self.unchanged = 0
+        # Fingerprint of the dataset state after the check (see Manifest.fingerprint)
+        self.fingerprint: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    @property
+    def truncated_rows(self) -> int:
+        return sum(self.truncated.values())
+
+    def image_files(self) -> List[Path]:
+        """All images of the directory, sorted by name."""
+        return [self.images[stem] for stem in sorted(self.images)]
+
+    def summary(self) -> str:
+        # The label files created by the check are not counted as labels of the dataset
+        created = len(self.missing_labels) if self.fixed else 0
+        lines = [f"Images: {len(self.images)}, labels: {len(self.labels) - created}" +
+                 (f", created: {created}" if created else "")]
+        if self.unchanged:
+            lines.append(f"Unchanged since last check: {self.unchanged}")
+        if self.missing_labels:
+            lines.append(f"Missing labels: {len(self.missing_labels)}" +
+                         (" (created empty label files)" if self.fixed else ""))
+        if self.orphan_labels:
+            lines.append(f"Labels without image: {len(self.orphan_labels)}")
+        if self.truncated:
+            lines.append(f"Rows with more than {KITTI_COLUMNS} fields: {self.truncated_rows} in {len(self.truncated)} label files" +
+                         (" (truncated)" if self.fixed else ""))
+        for name, error in sorted(self.errors.items()):
+            lines.append(f"Error in {name}: {error}")
+        return '\n'.join(lines)
+
+
+def scan_dir(directory: Path, extensions: Tuple[str, ...]) -> Dict[str, Path]:
+    """Lists all files with one of the given extensions in a single pass. Returns a stem -> path mapping."""
+    files: Dict[str, Path] = {}
+    if not directory.is_dir():
+        return files
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext.lower() in extensions and entry.is_file():
+                files[stem] = directory.joinpath(entry.name)
+    return files
+
+
+def scan_kitti(kitti_dir: Path) -> Tuple[Dict[str, Path], Dict[str, Path]]:
+    """Scans 'image_2' and 'label_2' of a KITTI directory once each."""
+    images = scan_dir(kitti_dir.joinpath("image_2"), IMAGE_EXTENSIONS)
+    labels = scan_dir(kitti_dir.joinpath("label_2"), (LABEL_EXTENSION,))
+    return images, labels
+
+
+def create_kitti_dir(kitti_dir: Path):
+    """Creates the 'image_2' and 'label_2' directories of a KITTI directory."""
+    kitti_dir.joinpath("image_2").mkdir(parents=True, exist_ok=True)
+    kitti_dir.joinpath("label_2").mkdir(parents=True, exist_ok=True)
+
+
+def fix_label_file(label_file: Path) -> int:
+    """Cuts all rows of a label file down to KITTI_COLUMNS fields. Returns the number of truncated rows.
+
+    The file is only rewritten (once, atomically) if at least one row was truncated."""
+    rows: List[str] = []
+    truncated = 0
+    with open(label_file, 'r') as r:
+        for line in r:
+            row = line.split()
+            if len(row) > KITTI_COLUMNS:
+                row = row[:KITTI_COLUMNS]
+                truncated += 1
+            if row:
+                rows.append(" ".join(row))
+
+    if truncated:
+        write_atomic(label_file, "\n".join(rows) + "\n")
+    return truncated
+
+
+def label_classes(label_file: Path) -> List[str]:
+    """The class names of all objects in a label file."""
+    with open(label_file, 'r') as r:
+        return [row[0] for row in (line.split(None, 1) for line in r) if row]
+
+
+def count_oversized_rows(label_file: Path) -> int:
+    with open(label_file, 'r') as r:
+        return sum(1 for line in r if len(line.split()) > KITTI_COLUMNS)
+
+
+def _check_sample(manifest: Manifest, labels_dir: Path, stem: str, image_file: Path, label_file: Optional[Path], fix: bool) -> Tuple[str, bool, int, Optional[ManifestEntry], Optional[str]]:
+    """Returns (stem, unchanged, rows with too many fields, new manifest entry, error)."""
+    try:
+        if manifest.is_clean(stem, image_file, label_file):
+            return stem, True, 0, None, None
+
+        if label_file is None:
+            if not fix:
+                return stem, False, 0, None, None
+            label_file = labels_dir.joinpath(stem + LABEL_EXTENSION)
+            label_file.touch()
+            oversized = 0
+        else:
+            oversized = fix_label_file(
+                label_file) if fix else count_oversized_rows(label_file)
+
+        entry = manifest.entry_for(
+            image_file, label_file, 0 if fix else oversized)
+        return stem, False, oversized, entry, None
+    except OSError as e:
+        return stem, False, 0, None, str(e)
+
+
+def manifest_fingerprint(kitti_dir: Path, workers: Optional[int] = None) -> Optional[str]:
+    """Fingerprint of the manifest of a KITTI directory, if no sample changed since the directory was last checked.
+
+    Only compares file stats, no file is read. Returns None if the directory needs to be checked again."""
+    if not kitti_dir.is_dir():
+        return None
+
+    manifest = Manifest.load(kitti_dir)
+    images, labels = scan_kitti(kitti_dir)
+    if not images or images.keys() != manifest.entries.keys():
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        clean = all(executor.map(lambda stem: manifest.is_clean(
+            stem, images[stem], labels.get(stem)), images))
+    return manifest.fingerprint() if clean else None
+
+
+def check_kitti(kitti_dir: Path, fix: bool = True, workers: Optional[int] = None,
+                rebuild_manifest: bool = False, hash_files: bool = False) -> KittiReport:
+    """Validates a KITTI directory and fixes its label files.
+
+    Images without a label file get an empty one and rows with more than KITTI_COLUMNS fields are truncated.
+    Label files are processed on a thread pool. Samples that did not change since the last successful check
+    (according to the manifest of the directory) are skipped, unless 'rebuild_manifest' is set.
+    """
+    assert kitti_dir.exists(), f"The directory {kitti_dir} does not exist"
+
+    with span('scan_kitti', kitti_dir=kitti_dir.as_posix()) as counters:
+        images, labels = scan_kitti(kitti_dir)
+        counters['files'] = len(images) + len(labels)
+    assert len(images) > 0, f"No samples found in dataset {kitti_dir}"
+
+    report = KittiReport(kitti_dir, images, labels, fixed=fix)
+    labels_dir = kitti_dir.joinpath("label_2")
+    if fix:
+        labels_dir.mkdir(exist_ok=True)
+
+    manifest = Manifest(kitti_dir, hash_files) if rebuild_manifest else Manifest.load(
+        kitti_dir, hash_files)
+    stems = sorted(images)
+    changed = len(manifest.entries) != len(images)
+
+    with span('check_labels', kitti_dir=kitti_dir.as_posix()) as counters, ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda stem: _check_sample(
+            manifest, labels_dir, stem, images[stem], labels.get(stem), fix), stems)
+        for stem, unchanged, oversized, entry, error in results:
+            if unchanged:
+                report.unchanged += 1
+                continue
+
+            changed = True
+            label_name = stem + LABEL_EXTENSION
+            if error is not None:
+                report.errors[label_name] = error
+                manifest.entries.pop(stem, None)
+                continue
+            if stem not in labels:
+                report.missing_labels.append(stem)
+                if fix:
+                    report.labels[stem] = labels_dir.joinpath(label_name)
+            if oversized:
+                report.truncated[label_name] = oversized
+            if entry is not None:
+                manifest.entries[stem] = entry
+        counters.update(files=len(stems), checked=len(stems) - report.unchanged,
+                        fixed=len(report.missing_labels) + len(report.truncated) if fix else 0)
+
+    manifest.retain(images)
+    if fix and (changed or manifest.dirty):
+        manifest.save()
+    report.fingerprint = manifest.fingerprint()
+
+    print(report.summary())
+    assert report.ok, f"Checking the dataset {kitti_dir} failed"
+    if report.unchanged == len(stems):
+        print(f"Labels for {len(stems)} images unchanged since last check.")
+    else:
+        print(
+            f"Checked labels for {len(stems) - report.unchanged} images. All good.")
+    return report
@@ -0,0 +1,190 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .kitti import KITTI_COLUMNS, KittiReport
+from .output import format_table
+from .trace import span
+
+# Edges of the box size histograms (sqrt of the box area in pixels, small / medium / large as in COCO at 32 and 96)
+SIZE_BINS = [0, 16, 32, 64, 96, 128, 256, 512, float('inf')]
+# Edges of the aspect ratio (width / height) histograms
+ASPECT_BINS = [0, 1 / 4, 1 / 2, 2 / 3, 3 / 2, 2, 4, float('inf')]
+PERCENTILES = [5, 25, 50, 75, 95]
+# Columns of the box (left, top, right, bottom) in a KITTI row
+BOX_COLUMNS = slice(4, 8)
+
+
+def parse_labels(files: List[Optional[str]]) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """Parses a batch of label files (None for an image without label file).
+
+    Returns the class names of the batch, the class index (into the names) and box of each object, and the number
+    of objects per file. All rows of a batch are converted at once; rows are expected to have KITTI_COLUMNS fields
+    (see check_kitti), rows with fewer fields than a box are skipped."""
+    tokens: List[bytes] = []
+    counts = np.zeros(len(files), dtype=np.int32)
+    for i, file in enumerate(files):
+        if file is None:
+            continue
+        with open(file, 'rb') as r:
+            data = r.read()
+        fields = data.split()
+        lines = data.splitlines()
+        rows = len(lines) - lines.count(b'')
+        if len(fields) == rows * KITTI_COLUMNS:
+            # Checked labels have at most KITTI_COLUMNS fields per row, so every row has exactly as many
+            tokens += fields
+        else:
+            # Rows of other lengths: pad or cut each row to KITTI_COLUMNS fields
+            rows = 0
+            for line in lines:
+                row = line.split()
+                if len(row) >= BOX_COLUMNS.stop:
+                    tokens += (row + [b'0'] * KITTI_COLUMNS)[:KITTI_COLUMNS]
+                    rows += 1
+        counts[i] = rows
+
+    table = np.array(tokens, dtype=bytes).reshape(-1, KITTI_COLUMNS)
+    names, classes = np.unique(table[:, 0], return_inverse=True)
+    boxes = table[:, BOX_COLUMNS].astype(np.float32)
+    return [name.decode(errors='replace') for name in names], classes.astype(np.int32).reshape(-1), boxes, counts
+
+
+def iou_wh(wh: np.ndarray, anchors: np.ndarray) -> np.ndarray:
+    """IoU of boxes and anchors (both as width, height) placed at the same center. Shape (boxes, anchors)."""
+    intersection = np.minimum(wh[:, None, 0], anchors[None, :, 0]) * np.minimum(wh[:, None, 1], anchors[None, :, 1])
+    return intersection / (wh[:, 0:1] * wh[:, 1:2] + (anchors[:, 0] * anchors[:, 1])[None, :] - intersection)
+
+
+def kmeans_anchors(wh: np.ndarray, k: int, iterations: int = 100, sample: int = 20000, seed: int = 0) -> Tuple[np.ndarray, float]:
+    """k-means of the box sizes with 1 - IoU as distance (as used for YOLO anchors), on at most 'sample' boxes.
+    Returns the anchors sorted by area and the mean IoU of each box with its best anchor."""
+    rng = np.random.default_rng(seed)
+    if len(wh) > sample:
+        wh = wh[rng.choice(len(wh), sample, replace=False)]
+    unique = np.unique(wh, axis=0)
+    anchors = unique[rng.choice(len(unique), min(k, len(unique)), replace=False)]
+    k = len(anchors)
+    assignment = None
+    for _ in range(iterations):
+        nearest = iou_wh(wh, anchors).argmax(axis=1)
+        if assignment is not None and np.array_equal(nearest, assignment):
+            break
+        assignment = nearest
+        for i in range(k):
+            members = wh[assignment == i]
+            if len(members):
+                anchors[i] = np.median(members, axis=0)
+    anchors = anchors[np.argsort(anchors[:, 0] * anchors[:, 1])]
+    return anchors, float(iou_wh(wh, anchors).max(axis=1).mean())
+
+
+def box_summary(wh: np.ndarray) -> Dict[str, Any]:
+    """Distribution of the box sizes: percentiles of width and height, size and aspect ratio histograms."""
+    sizes = np.sqrt(wh[:, 0] * wh[:, 1])
+    return {
+        'width': np.percentile(wh[:, 0], PERCENTILES).round(1).tolist() if len(wh) else [],
+        'height': np.percentile(wh[:, 1], PERCENTILES).round(1).tolist() if len(wh) else [],
+        'sizes': np.histogram(sizes, SIZE_BINS)[0].tolist(),
+        'aspect_ratios': np.histogram(wh[:, 0] / wh[:, 1], ASPECT_BINS)[0].tolist(),
+    }
+
+
+def label_stats(report: KittiReport, workers: Optional[int] = None, batch_size: int = 2000, anchors: int = 9) -> Dict[str, Any]:
+    """Class counts, box size distributions and empty image ratio of a checked KITTI directory.
+
+    The label files are parsed in batches on a pool of 'workers' processes, the statistics are computed on the
+    concatenated arrays."""
+    stems = sorted(report.images)
+    files = [report.labels[stem].as_posix() if stem in report.labels else None for stem in stems]
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+
+    with span('label_stats', kitti_dir=report.kitti_dir.as_posix()) as counters:
+        # spawn: the scheduler runs jobs in threads, which must not be forked
+        workers = max(1, min(workers or os.cpu_count() or 1, len(batches)))
+        if workers == 1:
+            results = [parse_labels(batch) for batch in batches]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results = list(executor.map(parse_labels, batches))
+
+        # Map the class indices of each batch to the classes of the whole directory
+        names = sorted({name for batch_names, _, _, _ in results for name in batch_names})
+        index = {name: i for i, name in enumerate(names)}
+        classes = np.concatenate([np.array([index[name] for name in batch_names], dtype=np.int32)[batch_classes]
+                                  for batch_names, batch_classes, _, _ in results]) if results else np.zeros(0, np.int32)
+        boxes = np.concatenate([batch_boxes for _, _, batch_boxes, _ in results]).reshape(-1, 4)
+        counts = np.concatenate([batch_counts for _, _, _, batch_counts in results])
+        counters.update(files=len(files), objects=len(classes), workers=workers)
+
+    wh = np.stack([boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]], axis=1)
+    valid = (wh > 0).all(axis=1)
+    images_of_objects = np.repeat(np.arange(len(counts)), counts)
+    stats: Dict[str, Any] = {
+        'images': len(stems),
+        'empty_images': int((counts == 0).sum()),
+        'objects': int(len(classes)),
+        'degenerate_boxes': int((~valid).sum()),
+        'objects_per_image': {'mean': round(float(counts.mean()), 3) if len(counts) else 0.0,
+                              'max': int(counts.max()) if len(counts) else 0},
+        'size_bins': SIZE_BINS[:-1],
+        'aspect_bins': [round(edge, 3) for edge in ASPECT_BINS[:-1]],
+        'percentiles': PERCENTILES,
+        'boxes': box_summary(wh[valid]),
+        'classes': {},
+    }
+    for i, name in enumerate(names):
+        selected = classes == i
+        stats['classes'][name] = {
+            'objects': int(selected.sum()),
+            'images': int(len(np.unique(images_of_objects[selected]))),
+            **box_summary(wh[selected & valid]),
+        }
+    if anchors and valid.any():
+        anchor_wh, mean_iou = kmeans_anchors(wh[valid], anchors)
+        stats['anchors'] = {'sizes': anchor_wh.round(1).tolist(), 'mean_iou': round(mean_iou, 4)}
+    return stats
+
+
+def bin_labels(edges: List[float]) -> List[str]:
+    """Labels of histogram bins given by their left edges: '<right edge', the last bin '<left edge>+'."""
+    return [f"<{edges[i + 1]:g}" if i + 1 < len(edges) else f"{edge:g}+" for i, edge in enumerate(edges)]
+
+
+def shares(counts: List[int]) -> List[str]:
+    """The share of each histogram bin in percent, 4 characters each."""
+    total = sum(counts)
+    return [f"{100 * count / total:3.0f}%" if total else '   -' for count in counts]
+
+
+def format_stats(stats: Dict[str, Any]) -> str:
+    """Human readable summary of label_stats."""
+    lines = [f"Images: {stats['images']}, empty: {stats['empty_images']} "
+             f"({100 * stats['empty_images'] / max(stats['images'], 1):.1f}%), objects: {stats['objects']}, "
+             f"per image: {stats['objects_per_image']['mean']} (max {stats['objects_per_image']['max']})"]
+    if stats['degenerate_boxes']:
+        lines.append(f"Boxes without area (not in the box statistics): {stats['degenerate_boxes']}")
+
+    lines.append("Box sizes (sqrt of the area in pixels) per class:")
+    rows = [('class', 'objects', 'images', 'median w x h', ' '.join(label.rjust(4) for label in bin_labels(stats['size_bins'])))]
+    classes = sorted(stats['classes'].items(), key=lambda item: (-item[1]['objects'], item[0]))
+    everything = {**stats['boxes'], 'objects': stats['objects'], 'images': stats['images'] - stats['empty_images']}
+    for name, summary in classes + [('(all)', everything)]:
+        median = f"{summary['width'][2]:g} x {summary['height'][2]:g}" if summary['width'] else '-'
+        rows.append((name, str(summary['objects']), str(summary['images']), median, ' '.join(shares(summary['sizes']))))
+    lines.append(format_table(rows))
+
+    boxes = stats['boxes']
+    if boxes['width']:
+        percentiles = '/'.join(f"p{p}" for p in stats['percentiles'])
+        lines.append(f"Box width  {percentiles}: {' / '.join(f'{v:g}' for v in boxes['width'])}")
+        lines.append(f"Box height {percentiles}: {' / '.join(f'{v:g}' for v in boxes['height'])}")
+        lines.append("Aspect ratios (w/h): " + ', '.join(f"{label} {share.strip()}" for label, share in zip(
+            bin_labels(stats['aspect_bins']), shares(boxes['aspect_ratios']))))
+    if 'anchors' in stats:
+        lines.append(f"Anchors (w x h, k-means on IoU, mean IoU {stats['anchors']['mean_iou']}): " +
+                     ', '.join(f"{w:g}x{h:g}" for w, h in stats['anchors']['sizes']))
+    return '\n'.join(lines)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+from .fileutils import hash_file, write_atomic
+
+MANIFEST_FILENAME = '.manifest.json'
+MANIFEST_VERSION = 1
+
+# (size, mtime_ns) of a file
+FileStat = Tuple[int, int]
+
+
+def stat_file(file: Path) -> FileStat:
+    st = os.stat(file)
+    return st.st_size, st.st_mtime_ns
+
+
+class ManifestEntry:
+    """State of an image/label pair at the time it was last validated."""
+
+    def __init__(self, image: str, image_stat: FileStat, label_stat: FileStat, oversized_rows: int = 0,
+                 image_hash: Optional[str] = None, label_hash: Optional[str] = None):
+        self.image = image
+        self.image_stat = image_stat
+        self.label_stat = label_stat
+        # Validation result: rows with too many fields left in the label file
+        self.oversized_rows = oversized_rows
+        self.image_hash = image_hash
+        self.label_hash = label_hash
+
+    @property
+    def valid(self) -> bool:
+        return self.oversized_rows == 0
+
+    def to_row(self) -> list:
+        return [self.image, *self.image_stat, *self.label_stat, self.oversized_rows, self.image_hash, self.label_hash]
+
+    @classmethod
+    def from_row(cls, row: list) -> 'ManifestEntry':
+        return cls(row[0], (row[1], row[2]), (row[3], row[4]), row[5], row[6], row[7])
+
+
+class Manifest:
+    """Persistent record of the image/label pairs of a KITTI directory (stored as 'data/<dataset>/<subset>/.manifest.json').
+
+    Allows validation to skip every sample whose files did not change since it was last checked.
+    """
+
+    def __init__(self, kitti_dir: Path, hash_files: bool = False, entries: Optional[Dict[str, ManifestEntry]] = None):
+        self.kitti_dir = kitti_dir
+        self.file = kitti_dir.joinpath(MANIFEST_FILENAME)
+        self.hash_files = hash_files
+        self.entries: Dict[str, ManifestEntry] = entries if entries is not None else {}
+        # Set if stored stats were refreshed after a content comparison
+        self.dirty = False
+
+    @classmethod
+    def load(cls, kitti_dir: Path, hash_files: bool = False) -> 'Manifest':
+        """Loads the manifest of a KITTI directory. Returns an empty manifest if there is none or it is unreadable."""
+        manifest_file = kitti_dir.joinpath(MANIFEST_FILENAME)
+        try:
+            data = json.loads(manifest_file.read_bytes())
+        except (OSError, ValueError):
+            return cls(kitti_dir, hash_files)
+
+        if data.get('version') != MANIFEST_VERSION:
+            return cls(kitti_dir, hash_files)
+
+        entries = {stem: ManifestEntry.from_row(row)
+                   for stem, row in data['entries'].items()}
+        return cls(kitti_dir, hash_files or data.get('hash_files', False), entries)
+
+    def save(self):
+        data = {
+            'version': MANIFEST_VERSION,
+            'hash_files': self.hash_files,
+            'entries': {stem: entry.to_row() for stem, entry in self.entries.items()}
+        }
+        write_atomic(self.file, json.dumps(data, separators=(',', ':')))
+
+    def is_clean(self, stem: str, image_file: Path, label_file: Optional[Path]) -> bool:
+        """Whether the pair is unchanged since it was validated successfully.
+
+        Compares size and mtime first. With hashing enabled, files whose stat differs are compared by content,
+        so e.g. a 'touch' does not force a re-check (the stored stat is refreshed in that case)."""
+        entry = self.entries.get(stem)
+        if entry is None or label_file is None or not entry.valid or entry.image != image_file.name:
+            return False
+        if self.hash_files and (entry.image_hash is None or entry.label_hash is None):
+            # Hashing was enabled after the entry was recorded
+            return False
+
+        image_stat = stat_file(image_file)
+        label_stat = stat_file(label_file)
+        if image_stat == entry.image_stat and label_stat == entry.label_stat:
+            return True
+        if not self.hash_files:
+            return False
+
+        if hash_file(image_file) != entry.image_hash or hash_file(label_file) != entry.label_hash:
+            return False
+        entry.image_stat = image_stat
+        entry.label_stat = label_stat
+        self.dirty = True
+        return True
+
+    def entry_for(self, image_file: Path, label_file: Path, oversized_rows: int = 0) -> ManifestEntry:
+        """Captures the current state of a pair after it has been validated."""
+        return ManifestEntry(
+            image_file.name, stat_file(image_file), stat_file(label_file), oversized_rows,
+            hash_file(image_file) if self.hash_files else None,
+            hash_file(label_file) if self.hash_files else None)
+
+    def retain(self, stems: Iterable[str]):
+        """Drops all entries of samples that no longer exist."""
+        keep = set(stems)
+        for stem in [stem for stem in self.entries if stem not in keep]:
+            del self.entries[stem]
+
+    def fingerprint(self) -> str:
+        """Hash over the recorded state of all pairs. Changes whenever a sample is added, removed or modified."""
+        digest = hashlib.blake2b(digest_size=16)
+        for stem in sorted(self.entries):
+            digest.update(json.dumps([stem, *self.entries[stem].to_row()[:5]]).encode())
+        return digest.hexdigest()
@@ -0,0 +1,62 @@
+import sys
+import threading
+from typing import Callable, List, Optional, TextIO, Tuple
+
+
+class PrefixedOutput:
+    """Stream that prefixes every line written by a job thread with the name of its experiment."""
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def register(self, name: str):
+        """Prefixes all lines written by the current thread with 'name'."""
+        self._local.name = name
+        self._local.prefix = f"[{name}] "
+        self._local.buffer = ''
+
+    def current_name(self) -> Optional[str]:
+        return getattr(self._local, 'name', None)
+
+    def write(self, text: str) -> int:
+        prefix = getattr(self._local, 'prefix', None)
+        if prefix is None:
+            with self._lock:
+                return self.stream.write(text)
+
+        self._local.buffer += text
+        *lines, self._local.buffer = self._local.buffer.split('\n')
+        if lines:
+            with self._lock:
+                self.stream.write(''.join(prefix + line + '\n' for line in lines))
+                self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        prefix = getattr(self._local, 'prefix', None)
+        if prefix is not None and self._local.buffer:
+            self.write('\n')
+        with self._lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def keep_output_prefix() -> Callable[[], None]:
+    """Captures the output prefix of the calling job thread (see PrefixedOutput). Calling the returned function in
+    another thread (e.g. of a thread pool) prefixes the output of that thread the same way."""
+    name = sys.stdout.current_name() if isinstance(sys.stdout, PrefixedOutput) else None
+
+    def register():
+        if name is not None and isinstance(sys.stdout, PrefixedOutput):
+            sys.stdout.register(name)
+    return register
+
+
+def format_table(rows: List[Tuple[str, ...]]) -> str:
+    """Left-aligned columns, the first row being the header."""
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
@@ -2,6 +2,9 @@ import sys
 from argparse import ArgumentParser, SUPPRESS, Namespace
 from typing import List
 
+from ..fileutils import LINK_MODES
+from ..runs import GROUP_COLUMNS
+
 
 class Parser(object):
     """Argument parser that can handle arguments with our special
@@ -15,37 +18,149 @@ class Parser(object):
 
     def _add_arguments(self):
         """Adds arguments to parser."""
+        self._parser.add_argument(
+            '--profile', action='store_true', help='Run the python side of each job under cProfile and store the stats next to the trace (projects/<project>/.tao-runner/traces/)')
         subparsers = self._parser.add_subparsers(
             help='sub-command help', dest='command')
 
-        # Top-level parser
-        self._parser.add_argument('project', help='The name of the project')
-        self._parser.add_argument('experiments', nargs='+')
-        self._parser.add_argument('--overwrite',
-                                  action='store_true',
-                                  help='If this flag is set, the affected dirs will be deleted and recreated')
+        # Arguments shared by all sub-commands
+        common = ArgumentParser(add_help=False)
+        common.add_argument('project', help='The name of the project')
+        common.add_argument('experiments', nargs='+')
+        common.add_argument('--overwrite',
+                            action='store_true',
+                            help='If this flag is set, the affected dirs will be deleted and recreated')
+        common.add_argument('--rebuild-manifest',
+                            action='store_true',
+                            help='Ignore the dataset manifests and check every sample again')
+        common.add_argument('--manifest-hashes',
+                            action='store_true',
+                            help='Store content hashes in the dataset manifests, so touched but unchanged files are not checked again')
+        common.add_argument('-j', '--jobs', type=int, default=2,
+                            help='Number of experiments running CPU-only tasks (split, convert) at once. GPU tasks run as many experiments as there are free gpu_indices')
+
+        # Options of the split task, shared with 'run-pipeline'
+        split_options = ArgumentParser(add_help=False)
+        split_options.add_argument(
+            '--val', type=float, default=0.2, help='Percentage of the dataset to use for validation')
+        split_options.add_argument(
+            '--link-mode', choices=LINK_MODES, default='copy', help='How files are placed into the subsets. Falls back to copying if the filesystem does not support the mode')
+        split_options.add_argument(
+            '--workers', type=int, help='Number of threads copying files (default: number of CPUs + 4, at most 32)')
+        split_options.add_argument(
+            '--seed', type=int, default=0, help='Seed of the shuffle. The same seed and dataset always result in the same split')
+        split_options.add_argument(
+            '--stratified', action='store_true', help='Balance the class frequencies (parsed from label_2) between train and val')
+        split_options.add_argument(
+            '--index-only', action='store_true', help='Only write the train.txt / val.txt index files, without creating the train / val subsets')
+
+        # Options of the convert task, shared with 'run-pipeline'
+        convert_options = ArgumentParser(add_help=False)
+        convert_options.add_argument(
+            '--shards', type=int, default=1, help='Convert the dataset in this many parts. Only parts with changed images or labels are converted again')
+        convert_options.add_argument(
+            '--shard-jobs', type=int, help='Number of parts converted at once per experiment (default: number of CPUs / 4)')
+        convert_options.add_argument(
+            '--cache-budget', type=float, default=50.0, help='Size in GiB of the tfrecords cache of a dataset. Beyond it, tfrecords no experiment links to are removed, least recently used first')
 
         # 'split' command
         parser_split = subparsers.add_parser(
-            'split', help='Split a dataset into train / val subsets')
+            'split', parents=[common, split_options], help='Split a dataset into train / val subsets')
         parser_split.add_argument(
             '--subset', required=True, help='The dataset to split')
-        parser_split.add_argument(
-            '--val', default=0.2, help='Percentage of the dataset to use for validation')
 
         # 'convert' command
         parser_convert = subparsers.add_parser(
-            'convert', help='Convert a dataset to tfrecords')
+            'convert', parents=[common, convert_options], help='Convert a dataset to tfrecords')
 
         # 'train' command
-        parser_train = subparsers.add_parser('train', help='Train a model')
+        parser_train = subparsers.add_parser('train', parents=[common], help='Train a model')
         parser_train.add_argument(
             '-s', '--stop', help='Stop all running training sessions', action='store_true')
 
         # 'export' command
-        parser_export = subparsers.add_parser('export', help='Export a model')
-        parser_export.add_argument('-m', '--model',
-                                   help='The Filename of the model to export')
+        parser_export = subparsers.add_parser('export', parents=[common], help='Export a model')
+        parser_export.add_argument('-m', '--models',
+                                   help="Comma separated filenames (without .tlt) of the models to export or checkpoint selectors ('best', 'last', 'top-<k>') (default: export_model of the experiment)")
+        parser_export.add_argument('-t', '--data-types',
+                                   help='Comma separated data types (fp32, fp16, int8) to export each model with (default: export_type of the experiment)')
+        parser_export.add_argument('--parallel', type=int, default=2,
+                                   help='Number of exports running at once per experiment, spread over its gpus')
+
+        # 'metrics' command
+        parser_metrics = subparsers.add_parser(
+            'metrics', parents=[common], help='Extract the metrics from the training logs')
+        parser_metrics.add_argument(
+            '--formats', default='csv', help='Comma separated output formats per experiment (csv, npy)')
+        parser_metrics.add_argument(
+            '--plot', dest='plot_metrics', action='store_true', help='Plot each metric of all experiments to projects/<project>/metrics/')
+
+        # 'checkpoints' command
+        parser_checkpoints = subparsers.add_parser(
+            'checkpoints', parents=[common], help='List the checkpoints of the experiments with their metrics')
+        parser_checkpoints.add_argument(
+            '--select', help="Comma separated checkpoint selectors to mark: 'best', 'last' or 'top-<k>', ranked by mAP or e.g. 'best:loss'")
+        parser_checkpoints.add_argument(
+            '--prune', action='store_true', help='Delete all checkpoints except the selected and the last one')
+
+        # 'stats' command
+        parser_stats = subparsers.add_parser(
+            'stats', parents=[common], help='Show class counts, box size distributions and anchors of the dataset subsets')
+        parser_stats.add_argument(
+            '--subsets', default='full,train,val', help='Comma separated subsets of the dataset to analyze. Missing subsets are skipped')
+        parser_stats.add_argument(
+            '--workers', type=int, help='Number of processes parsing the label files (default: number of CPUs)')
+        parser_stats.add_argument(
+            '--anchors', type=int, default=9, help='Number of anchor sizes to fit to the boxes with k-means (0 to skip)')
+
+        # 'fetch-models' command
+        parser_fetch = subparsers.add_parser(
+            'fetch-models', help='Download the pretrained models (repository / backbone) used by the experiments')
+        parser_fetch.add_argument('project', help='The name of the project')
+        parser_fetch.add_argument(
+            'experiments', nargs='*', help='The experiments whose models to fetch (default: all experiments of the project)')
+        parser_fetch.add_argument(
+            '--workers', type=int, default=4, help='Number of models downloaded at once')
+        parser_fetch.add_argument(
+            '--retries', type=int, default=3, help='Number of retries of a failed download')
+        parser_fetch.add_argument(
+            '--ngc', default='ngc', help='The ngc cli executable')
+        parser_fetch.add_argument(
+            '--force', action='store_true', help='Download the models, even if they are already present')
+
+        # Arguments of the commands querying the run database (all projects if no project is given)
+        runs_query = ArgumentParser(add_help=False)
+        runs_query.add_argument('project', nargs='?', help='Only show runs of this project')
+        runs_query.add_argument('experiments', nargs='*', help='Only show runs of these experiments')
+
+        # 'status' command
+        parser_status = subparsers.add_parser(
+            'status', parents=[runs_query], help='Show the last run of each task per experiment from the run database')
+        parser_status.add_argument(
+            '--stale', action='store_true', help='Only show tasks whose config or specs changed or whose inputs were produced again since they ran')
+        parser_status.add_argument(
+            '--best', metavar='METRIC', help="Show the best value of a metric (e.g. 'mAP', 'loss') per --by instead")
+        parser_status.add_argument(
+            '--by', default='backbone', choices=GROUP_COLUMNS, help='What --best is grouped by')
+
+        # 'history' command
+        parser_history = subparsers.add_parser(
+            'history', parents=[runs_query], help='List the recorded runs, newest first')
+        parser_history.add_argument('--task', help='Only show runs of this task')
+        parser_history.add_argument('--failed', action='store_true', help='Only show failed runs')
+        parser_history.add_argument('-n', '--limit', type=int, default=50, help='Number of runs to show')
+        parser_history.add_argument(
+            '--sql', help="Run an SQL query on the run database instead (tables 'runs', 'metrics' and 'experiments')")
+
+        # 'run-pipeline' command
+        parser_pipeline = subparsers.add_parser(
+            'run-pipeline', parents=[common, split_options, convert_options], help='Run split, convert, train and export, skipping the stages that are up to date')
+        parser_pipeline.add_argument(
+            '--stages', help='Comma separated list of stages to run (default: all, split only if --subset is set)')
+        parser_pipeline.add_argument(
+            '--subset', help='The dataset to split')
+        parser_pipeline.add_argument(
+            '--force', action='store_true', help='Run all stages, even if they are up to date')
 
     def parse(self, args=None) -> Namespace:
         return self._parser.parse_args(args)
@@ -1,12 +1,109 @@
+import hashlib
+import pickle
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Tuple
 import yaml
 
+from ..fileutils import write_atomic
+
+# libyaml is much faster, if pyyaml was built with it
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+CACHE_VERSION = 1
+
+SCALAR = (str, int, float)
+# Key -> (allowed types, description) of the experiments.yml. Lists are checked element-wise.
+TAO_CONFIG_SCHEMA: Dict[str, Tuple[Tuple[type, ...], str]] = {
+    'gpus': ((int,), 'a number'),
+    'gpu_indices': ((list,), 'a list of gpu indices'),
+}
+EXPERIMENT_SCHEMA: Dict[str, Tuple[Tuple[type, ...], str]] = {
+    'head': ((str,), 'a string'),
+    'backbone': (SCALAR, 'a string'),
+    'repository': (SCALAR, 'a string'),
+    'model_key': (SCALAR, 'a string'),
+    'dataset': (SCALAR, 'a string'),
+    'export_model': (SCALAR + (list,), 'a string or a list of strings'),
+    'export_type': (SCALAR + (list,), 'a string or a list of strings'),
+}
+EXPORT_TYPES = ('fp32', 'fp16', 'int8')
+
+
+def _check_type(value: Any, types: Tuple[type, ...]) -> bool:
+    # bool is an int to python, but never a valid value
+    if isinstance(value, bool) or not isinstance(value, types):
+        return False
+    return not isinstance(value, list) or all(isinstance(item, SCALAR) and not isinstance(item, bool) for item in value)
+
+
+def _check_section(section: Any, schema: Dict[str, Tuple[Tuple[type, ...], str]], name: str) -> List[str]:
+    if not isinstance(section, dict):
+        return [f"'{name}' has to be a mapping"]
+    errors = []
+    for key, (types, description) in schema.items():
+        if key not in section:
+            errors.append(f"'{name}' is missing '{key}'")
+        elif not _check_type(section[key], types):
+            errors.append(f"'{name}.{key}' has to be {description}, got {section[key]!r}")
+    unknown = [key for key in section if key not in schema]
+    if unknown:
+        print(f"Warning: '{name}' has unknown keys, which are ignored: {', '.join(map(str, unknown))}")
+    return errors
+
+
+def validate(project: Dict[str, Any], experiments: List[str]) -> List[str]:
+    """Checks the tao_config and the given experiments of a parsed experiments.yml. Returns all errors found."""
+    if not isinstance(project, dict):
+        return ["The experiments file has to contain the mappings 'tao_config' and 'experiments'"]
+    errors = _check_section(project.get('tao_config'), TAO_CONFIG_SCHEMA, 'tao_config')
+    if not errors and project['tao_config']['gpus'] > len(project['tao_config']['gpu_indices']):
+        errors.append(f"'tao_config.gpus' is {project['tao_config']['gpus']}, but only "
+                      f"{len(project['tao_config']['gpu_indices'])} gpu_indices are configured")
+
+    defined = project.get('experiments')
+    if not isinstance(defined, dict):
+        return errors + ["'experiments' has to be a mapping of experiment names to their config"]
+    for experiment in experiments:
+        if experiment not in defined:
+            errors.append(f"Unknown experiment '{experiment}'")
+            continue
+        section_errors = _check_section(defined[experiment], EXPERIMENT_SCHEMA, experiment)
+        if not section_errors:
+            export_types = defined[experiment]['export_type']
+            for export_type in export_types if isinstance(export_types, list) else [export_types]:
+                if export_type not in EXPORT_TYPES:
+                    section_errors.append(f"'{experiment}.export_type' has to be one of {', '.join(EXPORT_TYPES)}, got {export_type!r}")
+        errors += section_errors
+    return errors
+
+
 class Parser():
     def parse(self, project: str) -> Dict[str, Any]:
+        """Loads the experiments.yml of a project.
+
+        The parsed file is cached in 'projects/<project>/.tao-runner/experiments.pickle' with the hash of its content,
+        so it is only parsed again after it changed."""
         experiments_file = Path('projects', project, 'experiments.yml')
         assert experiments_file.is_file(
         ), f'Experiments file {experiments_file} does not exist.'
 
-        return yaml.safe_load(experiments_file.read_bytes())
+        content = experiments_file.read_bytes()
+        key = hashlib.blake2b(content, digest_size=16).hexdigest()
+        cache_file = experiments_file.parent.joinpath('.tao-runner', 'experiments.pickle')
+        try:
+            cache = pickle.loads(cache_file.read_bytes())
+            if cache['version'] == CACHE_VERSION and cache['hash'] == key:
+                return cache['project']
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+            pass
+
+        parsed = yaml.load(content, Loader=Loader)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(cache_file, pickle.dumps(
+            {'version': CACHE_VERSION, 'hash': key, 'project': parsed}, protocol=pickle.HIGHEST_PROTOCOL))
+        return parsed
 
+    def validate(self, project: Dict[str, Any], experiments: List[str]):
+        """Fails with all errors of the given experiments, before any of them runs."""
+        errors = validate(project, experiments)
+        assert not errors, "Invalid experiments.yml:\n  " + "\n  ".join(errors)
@@ -0,0 +1,157 @@
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from .output import keep_output_prefix
+from .trace import span
+
+
+class RotatingLog:
+    """Appends lines to a file, which is rotated to '<file>.1', '<file>.2', ... once it exceeds 'max_bytes'."""
+
+    def __init__(self, file: Path, max_bytes: int = 64 * 2**20, backups: int = 3):
+        self.file = file
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self._stream = open(file, 'a')
+        self._size = self._stream.tell()
+
+    def write(self, line: str):
+        with self._lock:
+            if self._size + len(line) > self.max_bytes and self._size > 0:
+                self._rotate()
+            self._stream.write(line)
+            self._size += len(line)
+
+    def _rotate(self):
+        self._stream.close()
+        for i in range(self.backups - 1, 0, -1):
+            backup = self.file.with_name(f"{self.file.name}.{i}")
+            if backup.exists():
+                os.replace(backup, self.file.with_name(
+                    f"{self.file.name}.{i + 1}"))
+        if self.backups > 0:
+            os.replace(self.file, self.file.with_name(f"{self.file.name}.1"))
+        self._stream = open(self.file, 'w')
+        self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._stream.close()
+
+
+class FileTail(threading.Thread):
+    """Follows a file that is written by another process and passes each new line to 'on_line'."""
+
+    def __init__(self, file: Path, on_line: Callable[[str], None], interval: float = 1.0):
+        super().__init__(daemon=True)
+        self.file = file
+        self.on_line = on_line
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._offset = 0
+        self._partial = b''
+        self._keep_prefix = keep_output_prefix()
+
+    def run(self):
+        self._keep_prefix()
+        while not self._stopped.wait(self.interval):
+            self._read()
+        self._read()
+        if self._partial:
+            self.on_line(self._partial.decode(errors='replace') + '\n')
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def _read(self):
+        try:
+            if self.file.stat().st_size < self._offset:
+                # Truncated or replaced
+                self._offset = 0
+                self._partial = b''
+            with open(self.file, 'rb') as r:
+                r.seek(self._offset)
+                data = r.read()
+                self._offset = r.tell()
+        except FileNotFoundError:
+            return
+
+        *lines, self._partial = (self._partial + data).split(b'\n')
+        for line in lines:
+            self.on_line(line.decode(errors='replace') + '\n')
+
+
+# Exit codes of the tao processes each thread ran, see tao_exit_code and share_exit_codes
+_exit_codes = threading.local()
+
+
+def tao_exit_code() -> Optional[int]:
+    """The worst exit code of the tao processes run by the current thread and the threads sharing its exit codes: the
+    first non-zero one, 0 if all succeeded. None if no tao process ran."""
+    codes = getattr(_exit_codes, 'codes', [])
+    return next((code for code in codes if code != 0), 0) if codes else None
+
+
+def share_exit_codes() -> Callable[[], None]:
+    """Captures the exit codes of the calling thread. Calling the returned function in another thread (e.g. of a
+    thread pool) adds the exit codes of the tao processes run by that thread to them."""
+    if not hasattr(_exit_codes, 'codes'):
+        _exit_codes.codes = []
+    codes = _exit_codes.codes
+
+    def share():
+        _exit_codes.codes = codes
+    return share
+
+
+def run_process(command: List[str], log_file: Optional[Path] = None, tail_file: Optional[Path] = None, echo: bool = True) -> int:
+    """Runs a command and streams its output (stdout and stderr) line by line.
+
+    The output is printed (if 'echo' is set) and appended to 'log_file', which is rotated to keep it bounded.
+    If 'tail_file' is given (e.g. the --log_file of a TAO task), new lines written to it are printed as well.
+    Returns the exit code of the process.
+    """
+    log = RotatingLog(log_file) if log_file else None
+    tail = FileTail(tail_file, lambda line: print(
+        f"{tail_file.name}: {line}", end='')) if tail_file and echo else None
+
+    with span('process', command=' '.join(command[:3])) as counters:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL, text=True, errors='replace', bufsize=1)
+        if tail:
+            tail.start()
+        counters['lines'] = 0
+        try:
+            for line in process.stdout:
+                counters['lines'] += 1
+                if echo:
+                    print(line, end='')
+                if log:
+                    log.write(line)
+            counters['returncode'] = process.wait()
+            return counters['returncode']
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            if tail:
+                tail.stop()
+            if log:
+                log.close()
+
+
+def run_tao(command: List[str], log_file: Optional[Path] = None, tail_file: Optional[Path] = None) -> int:
+    """Runs a 'tao' command with run_process and fails if it exits with a non-zero status. The exit code is kept
+    for the run database (see tao_exit_code)."""
+    returncode = run_process(["tao", *command], log_file, tail_file)
+    share_exit_codes()
+    _exit_codes.codes.append(returncode)
+    assert returncode == 0, f"'tao {' '.join(command[:2])}' failed with exit code {returncode}" + \
+        (f". See {log_file}" if log_file else "")
+    return returncode
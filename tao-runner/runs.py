@@ -0,0 +1,258 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .checkpoints import LOWER_IS_BETTER
+from .context import ExperimentContext
+from .fileutils import hash_file
+from .train_log import MetricsLog
+
+# Relative to the workspace (the directory tao-runner runs in), shared by all projects
+RUNS_DB_FILE = Path('.tao-runner', 'runs.sqlite')
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    command TEXT NOT NULL,
+    project TEXT NOT NULL,
+    experiment TEXT NOT NULL,
+    task TEXT NOT NULL,
+    head TEXT,
+    backbone TEXT,
+    repository TEXT,
+    dataset TEXT,
+    config_hash TEXT,
+    spec_hash TEXT,
+    started TEXT NOT NULL,
+    seconds REAL,
+    status TEXT NOT NULL,
+    exit_code INTEGER,
+    error TEXT,
+    artifacts TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_task ON runs (project, experiment, task, id);
+
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    last REAL,
+    best REAL,
+    best_epoch INTEGER,
+    epochs INTEGER,
+    PRIMARY KEY (run_id, name)
+);
+
+-- The config of each experiment as of the last invocation that included it
+CREATE TABLE IF NOT EXISTS experiments (
+    project TEXT NOT NULL,
+    experiment TEXT NOT NULL,
+    head TEXT,
+    backbone TEXT,
+    repository TEXT,
+    dataset TEXT,
+    config_hash TEXT,
+    spec_hashes TEXT,
+    seen TEXT NOT NULL,
+    PRIMARY KEY (project, experiment)
+);
+"""
+
+# Columns of the runs that results can be grouped by (see RunDatabase.best)
+GROUP_COLUMNS = ('project', 'experiment', 'head', 'backbone', 'repository', 'dataset')
+
+
+def config_hash(config: Dict[str, Any]) -> str:
+    """Hash of the section of an experiment in the experiments.yml."""
+    return hashlib.blake2b(json.dumps(config, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def spec_hashes(context: ExperimentContext) -> Dict[str, str]:
+    """File name -> hash of each spec template of an experiment (convert.txt, train.txt, ...)."""
+    try:
+        files = sorted(file for file in context.local_paths.specs_dir.iterdir() if file.is_file())
+    except FileNotFoundError:
+        return {}
+    return {file.name: hash_file(file) for file in files}
+
+
+def final_metrics(log: MetricsLog) -> Dict[str, Tuple[Optional[float], Optional[float], Optional[int], int]]:
+    """Per metric of a training log: (last value, best value, epoch of the best value, number of epochs)."""
+    log.update()
+    rows = log.rows()
+    result = {}
+    for i, name in enumerate(log.metrics, start=1):
+        values = [(row[i], int(row[0])) for row in rows if row[i] is not None]
+        if not values:
+            continue
+        best = min(values) if name in LOWER_IS_BETTER else max(values, key=lambda value: (value[0], -value[1]))
+        result[name] = (values[-1][0], best[0], best[1], len(values))
+    return result
+
+
+def format_seconds(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class RunDatabase:
+    """SQLite database of all task runs (per experiment) of the workspace.
+
+    Runs are recorded when their job finishes, so the history survives deleted model dirs and can be queried across
+    projects without reading any logs."""
+
+    def __init__(self, file: Path = RUNS_DB_FILE):
+        self.file = file
+        self._lock = threading.Lock()
+        file.parent.mkdir(parents=True, exist_ok=True)
+        # Jobs of the scheduler record from their own threads, the lock serializes them
+        self._connection = sqlite3.connect(file, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        with self._connection:
+            version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                # WAL lets 'status' read while other invocations write
+                self._connection.execute('PRAGMA journal_mode = WAL')
+                self._connection.executescript(SCHEMA)
+                self._connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def query(self, sql: str, parameters: Iterable[Any] = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._connection.execute(sql, tuple(parameters)).fetchall()
+
+    def update_experiments(self, contexts: List[ExperimentContext], configs: Dict[str, Dict[str, Any]]):
+        """Stores the current config and spec hashes of the experiments, which later runs are compared to."""
+        now = datetime.now().isoformat(timespec='seconds')
+        rows = [(context.project, context.experiment, context.config.head, str(context.config.backbone),
+                 str(context.config.repository), str(context.config.dataset), config_hash(configs[context.experiment]),
+                 json.dumps(spec_hashes(context)), now) for context in contexts]
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO experiments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def record(self, command: str, task: str, context: ExperimentContext, started: datetime, seconds: Optional[float],
+               status: str, exit_code: Optional[int] = None, error: Optional[str] = None,
+               artifacts: Optional[List[Path]] = None,
+               metrics: Optional[Dict[str, Tuple[Optional[float], Optional[float], Optional[int], int]]] = None,
+               spec_template: Optional[str] = None) -> int:
+        """Adds a finished run. The config hash and the hash of the task's spec template (its file name, None for tasks
+        without one) are taken from the experiments table."""
+        with self._lock, self._connection:
+            hashes = self._connection.execute(
+                'SELECT config_hash, spec_hashes FROM experiments WHERE project = ? AND experiment = ?',
+                (context.project, context.experiment)).fetchone()
+            spec_hash = json.loads(hashes['spec_hashes'] or '{}').get(spec_template) if hashes and spec_template else None
+            cursor = self._connection.execute(
+                'INSERT INTO runs (command, project, experiment, task, head, backbone, repository, dataset, config_hash, '
+                'spec_hash, started, seconds, status, exit_code, error, artifacts) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (command, context.project, context.experiment, task, context.config.head, str(context.config.backbone),
+                 str(context.config.repository), str(context.config.dataset),
+                 hashes['config_hash'] if hashes else None, spec_hash,
+                 started.isoformat(timespec='seconds'), seconds, status, exit_code, error,
+                 json.dumps([artifact.as_posix() for artifact in artifacts or []])))
+            run_id = cursor.lastrowid
+            self._connection.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?)',
+                                         [(run_id, name, *values) for name, values in (metrics or {}).items()])
+        return run_id
+
+    @staticmethod
+    def _filter(project: Optional[str], experiments: List[str], table: str = 'runs') -> Tuple[str, List[Any]]:
+        conditions, parameters = [], []
+        if project:
+            conditions.append(f'{table}.project = ?')
+            parameters.append(project)
+        if experiments:
+            conditions.append(f"{table}.experiment IN ({', '.join('?' * len(experiments))})")
+            parameters += experiments
+        return ' AND '.join(conditions) or '1', parameters
+
+    def history(self, project: Optional[str] = None, experiments: List[str] = (), task: Optional[str] = None,
+                failed: bool = False, limit: int = 50) -> List[sqlite3.Row]:
+        """The most recent runs, newest first."""
+        where, parameters = self._filter(project, list(experiments))
+        if task:
+            where += ' AND task = ?'
+            parameters.append(task)
+        if failed:
+            where += " AND status = 'failed'"
+        return self.query(f'SELECT * FROM runs WHERE {where} ORDER BY id DESC LIMIT ?', parameters + [limit])
+
+    def latest(self, project: Optional[str] = None, experiments: List[str] = ()) -> List[sqlite3.Row]:
+        """The last run of each task of each experiment, with the experiment's current hashes and the best mAP of the
+        experiment's last run with metrics."""
+        where, parameters = self._filter(project, list(experiments))
+        return self.query(f"""
+            SELECT runs.*, experiments.config_hash AS current_config_hash,
+                (SELECT MAX(id) FROM runs AS done WHERE done.project = runs.project AND done.experiment = runs.experiment
+                    AND done.task = runs.task AND done.status = 'done') AS done_id,
+                (SELECT metrics.best FROM metrics JOIN runs AS measured ON measured.id = metrics.run_id
+                    WHERE measured.project = runs.project AND measured.experiment = runs.experiment
+                    AND metrics.name = 'mAP' ORDER BY measured.id DESC LIMIT 1) AS best_map
+            FROM runs LEFT JOIN experiments USING (project, experiment)
+            WHERE runs.id IN (SELECT MAX(id) FROM runs GROUP BY project, experiment, task) AND {where}
+            ORDER BY runs.project, runs.experiment, runs.id""", parameters)
+
+    def stale(self, depends_on: Dict[str, List[str]], specs: Dict[str, str], project: Optional[str] = None,
+              experiments: List[str] = ()) -> Dict[Tuple[str, str, str], str]:
+        """(project, experiment, task) -> reason, for each task whose last successful run is outdated: the config of
+        the experiment or the spec template the task uses ('specs', task -> file name) changed since, or a task it
+        depends on ran successfully after it. Only the tasks in 'depends_on' (those producing outputs) are considered."""
+        where, parameters = self._filter(project, list(experiments))
+        rows = self.query(f"""
+            SELECT runs.id, runs.project, runs.experiment, runs.task, runs.config_hash, runs.spec_hash,
+                experiments.config_hash AS current_config_hash, experiments.spec_hashes AS current_spec_hashes
+            FROM runs LEFT JOIN experiments USING (project, experiment)
+            WHERE runs.id IN (SELECT MAX(id) FROM runs WHERE status = 'done' GROUP BY project, experiment, task)
+                AND {where}""", parameters)
+        done = {(row['project'], row['experiment'], row['task']): row for row in rows if row['task'] in depends_on}
+        result = {}
+        for (project_name, experiment, task), row in done.items():
+            current_spec_hashes = json.loads(row['current_spec_hashes']) if row['current_spec_hashes'] else None
+            if row['current_config_hash'] and row['config_hash'] != row['current_config_hash']:
+                result[(project_name, experiment, task)] = 'config changed'
+            elif task in specs and current_spec_hashes is not None and row['spec_hash'] != current_spec_hashes.get(specs[task]):
+                result[(project_name, experiment, task)] = f"{specs[task]} changed"
+            else:
+                newer = [dependency for dependency in depends_on.get(task, [])
+                         if (project_name, experiment, dependency) in done
+                         and done[(project_name, experiment, dependency)]['id'] > row['id']]
+                if newer:
+                    result[(project_name, experiment, task)] = f"{', '.join(newer)} ran after it"
+        # Outdated inputs make everything downstream outdated as well
+        changed = True
+        while changed:
+            changed = False
+            for (project_name, experiment, task) in done:
+                if (project_name, experiment, task) in result:
+                    continue
+                upstream = [dependency for dependency in depends_on.get(task, [])
+                            if (project_name, experiment, dependency) in result]
+                if upstream:
+                    result[(project_name, experiment, task)] = f"{', '.join(upstream)} is stale"
+                    changed = True
+        return result
+
+    def best(self, metric: str, group_by: str, project: Optional[str] = None,
+             experiments: List[str] = ()) -> List[sqlite3.Row]:
+        """The best value of a metric per value of 'group_by' (one of GROUP_COLUMNS), with the run it came from."""
+        assert group_by in GROUP_COLUMNS, f"Cannot group by '{group_by}'. Use one of {', '.join(GROUP_COLUMNS)}"
+        where, parameters = self._filter(project, list(experiments))
+        # SQLite takes the bare columns from the row holding the MIN / MAX
+        aggregate = 'MIN' if metric in LOWER_IS_BETTER else 'MAX'
+        return self.query(f"""
+            SELECT runs.{group_by} AS grouped, {aggregate}(metrics.best) AS best, metrics.best_epoch,
+                runs.project, runs.experiment, runs.started, COUNT(DISTINCT runs.project || '/' || runs.experiment) AS experiments
+            FROM metrics JOIN runs ON runs.id = metrics.run_id
+            WHERE metrics.name = ? AND metrics.best IS NOT NULL AND {where}
+            GROUP BY runs.{group_by} ORDER BY best {'ASC' if aggregate == 'MIN' else 'DESC'}""", [metric] + parameters)
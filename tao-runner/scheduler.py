@@ -0,0 +1,210 @@
+import sys
+import threading
+import traceback
+from collections import defaultdict
+from pathlib import Path
+from time import monotonic
+from typing import Callable, Dict, List, Optional
+
+from .context import ExperimentContext
+from .output import PrefixedOutput, format_table
+from .trace import profiled, span
+
+
+class Job:
+    """A task running for a single experiment.
+
+    'depends_on' jobs have to succeed before the job starts. If 'up_to_date' returns True once they did, the job is
+    not run at all. 'task_name' names the task in the run database (defaults to the command). Jobs that
+    'modify_dataset' do not run at the same time as other such jobs on the same dataset."""
+
+    def __init__(self, context: ExperimentContext, task: Callable[[ExperimentContext], None], uses_gpu: bool = False,
+                 name: Optional[str] = None, depends_on: Optional[List['Job']] = None,
+                 up_to_date: Optional[Callable[[], bool]] = None, on_success: Optional[Callable[[], None]] = None,
+                 task_name: Optional[str] = None, modifies_dataset: bool = False):
+        self.context = context
+        self.task = task
+        self.task_name = task_name
+        self.uses_gpu = uses_gpu
+        self.modifies_dataset = modifies_dataset
+        self.name = name or context.experiment
+        self.depends_on = depends_on or []
+        self.up_to_date = up_to_date
+        self.on_success = on_success
+        self.status = 'queued'
+        self.gpus: List[int] = []
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def pending(self) -> bool:
+        return self.status in ('queued', 'running')
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status in ('done', 'up-to-date')
+
+    def elapsed(self) -> str:
+        if self.started is None:
+            return '-'
+        seconds = int((self.finished or monotonic()) - self.started)
+        return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class Scheduler:
+    """Runs jobs of multiple experiments concurrently.
+
+    GPU tasks get a slice of 'gpus' indices from the configured 'gpu_indices' each and are queued until a slice is free.
+    CPU-only tasks run up to 'cpu_jobs' at once, but never two that modify the same dataset.
+    'on_finished' is called from the thread of each job once its final status is set (e.g. to record the run).
+    """
+
+    def __init__(self, gpu_indices: List[int], gpus_per_job: int, cpu_jobs: int = 2, status_interval: float = 60.0,
+                 on_finished: Optional[Callable[[Job], None]] = None):
+        assert gpus_per_job <= len(gpu_indices), \
+            f"Each experiment requires {gpus_per_job} gpus, but only {len(gpu_indices)} gpu_indices are configured"
+        self.free_gpus = list(gpu_indices)
+        self.gpus_per_job = gpus_per_job
+        self.cpu_jobs = max(1, cpu_jobs)
+        self.status_interval = status_interval
+        self.on_finished = on_finished
+        self.jobs: List[Job] = []
+        self._changed = threading.Condition()
+        self._running_cpu = 0
+        self._busy_datasets: Dict[Path, int] = defaultdict(int)
+
+    def run_task(self, contexts: List[ExperimentContext], task: Callable[[ExperimentContext], None], uses_gpu: bool,
+                 modifies_dataset: bool = False) -> bool:
+        """Runs the task for every context. Returns whether all jobs succeeded."""
+        return self.run([Job(context, task, uses_gpu, modifies_dataset=modifies_dataset) for context in contexts])
+
+    def run(self, jobs: List[Job]) -> bool:
+        """Runs all jobs as soon as their dependencies succeeded. Returns whether all jobs succeeded."""
+        self.jobs = jobs
+        parallel = len(self.jobs) > 1
+        stdout = sys.stdout
+        if parallel:
+            sys.stdout = PrefixedOutput(stdout)
+
+        threads = [threading.Thread(target=self._run_job, args=(job,), name=job.name)
+                   for job in self.jobs]
+        try:
+            for thread in threads:
+                thread.start()
+
+            with self._changed:
+                last_state, last_print = None, 0.0
+                while any(job.pending for job in self.jobs):
+                    state = [(job.status, job.gpus) for job in self.jobs]
+                    if parallel and (state != last_state or monotonic() - last_print >= self.status_interval):
+                        print(self.status_table())
+                        last_state, last_print = state, monotonic()
+                    self._changed.wait(self.status_interval)
+
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.stdout = stdout
+
+        if parallel:
+            print(self.status_table())
+        for job in self.jobs:
+            if job.error:
+                print(f"{job.name} failed: {job.error}")
+        return all(job.succeeded for job in self.jobs)
+
+    def status_table(self) -> str:
+        rows = [('job', 'status', 'gpus', 'elapsed')]
+        for job in self.jobs:
+            rows.append((job.name, job.status, ','.join(str(i) for i in job.gpus) or '-', job.elapsed()))
+        return format_table(rows)
+
+    def _set_status(self, job: Job, status: str, error: Optional[str] = None):
+        with self._changed:
+            job.status = status
+            job.error = error
+            self._changed.notify_all()
+
+    def _wait_for_dependencies(self, job: Job) -> bool:
+        with self._changed:
+            self._changed.wait_for(
+                lambda: not any(dependency.pending for dependency in job.depends_on))
+        return all(dependency.succeeded for dependency in job.depends_on)
+
+    def _acquire(self, job: Job):
+        dataset_dir = job.context.local_paths.dataset_dir
+        with self._changed:
+            if job.uses_gpu:
+                self._changed.wait_for(
+                    lambda: len(self.free_gpus) >= self.gpus_per_job)
+                job.gpus = self.free_gpus[:self.gpus_per_job]
+                del self.free_gpus[:self.gpus_per_job]
+            else:
+                self._changed.wait_for(lambda: self._running_cpu < self.cpu_jobs and not (
+                    job.modifies_dataset and self._busy_datasets[dataset_dir]))
+                self._running_cpu += 1
+                if job.modifies_dataset:
+                    self._busy_datasets[dataset_dir] += 1
+            job.status = 'running'
+            job.started = monotonic()
+            self._changed.notify_all()
+
+    def _release(self, job: Job, status: str, error: Optional[str] = None):
+        with self._changed:
+            if job.uses_gpu:
+                self.free_gpus = sorted(self.free_gpus + job.gpus)
+            else:
+                self._running_cpu -= 1
+                if job.modifies_dataset:
+                    self._busy_datasets[job.context.local_paths.dataset_dir] -= 1
+            job.finished = monotonic()
+            job.status = status
+            job.error = error
+            self._changed.notify_all()
+
+    def _run_job(self, job: Job):
+        if isinstance(sys.stdout, PrefixedOutput):
+            sys.stdout.register(job.name)
+        try:
+            self._execute(job)
+        finally:
+            if self.on_finished is not None:
+                try:
+                    self.on_finished(job)
+                except Exception as e:
+                    print(f"Warning: on_finished failed for {job.name}: {type(e).__name__}: {e}")
+
+    def _execute(self, job: Job):
+        if not self._wait_for_dependencies(job):
+            self._set_status(job, 'skipped')
+            return
+
+        try:
+            if job.up_to_date is not None and job.up_to_date():
+                self._set_status(job, 'up-to-date')
+                return
+        except Exception as e:
+            self._set_status(job, 'failed', f"{type(e).__name__}: {e}")
+            return
+
+        self._acquire(job)
+        status, error = 'done', None
+        try:
+            print(f"Experiment: {job.context.experiment}")
+            if job.uses_gpu:
+                job.context.tao.assign_gpus(job.gpus)
+            with span('job', name=job.name, experiment=job.context.experiment, gpus=job.gpus), profiled(job.name):
+                job.task(job.context)
+            if job.on_success is not None:
+                job.on_success()
+        except Exception as e:
+            # Failed assertions are the expected errors (missing files, ...), their message is enough
+            if not isinstance(e, AssertionError):
+                traceback.print_exc(file=sys.stdout)
+            status, error = 'failed', f"{type(e).__name__}: {e}"
+        finally:
+            try:
+                sys.stdout.flush()
+            finally:
+                self._release(job, status, error)
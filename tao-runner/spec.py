@@ -0,0 +1,112 @@
+import hashlib
+import re
+import threading
+from pathlib import Path
+from string import Template
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .context import ExperimentContext
+from .trace import span
+
+# Variable name -> function returning its value (None if not available).
+# Values are only computed if a spec uses the variable.
+SpecVariables = Dict[str, Callable[[], Optional[str]]]
+
+
+class SpecTemplate:
+    """A tao spec file with '$variable' / '${variable}' placeholders ('$$' for a literal '$')."""
+
+    def __init__(self, text: str, name: str = 'spec'):
+        self.name = name
+        self.template = Template(text)
+        self.placeholders: List[str] = []
+        invalid = []
+        for match in self.template.pattern.finditer(text):
+            placeholder = match.group('named') or match.group('braced')
+            if placeholder and placeholder not in self.placeholders:
+                self.placeholders.append(placeholder)
+            elif match.group('invalid') is not None:
+                line = text.count('\n', 0, match.start()) + 1
+                invalid.append(f"line {line}")
+        assert not invalid, f"Invalid placeholders in {name} ({', '.join(invalid)}). Use '$$' for a literal '$'"
+
+    def values(self, variables: SpecVariables) -> Tuple[Tuple[str, str], ...]:
+        """Computes the values of all placeholders. Fails on unknown variables and variables without a value."""
+        unknown = [name for name in self.placeholders if name not in variables]
+        assert not unknown, f"Unknown variables in {self.name}: {', '.join('$' + name for name in unknown)}. " + \
+            f"Available: {', '.join('$' + name for name in variables)}"
+
+        values = tuple((name, variables[name]()) for name in self.placeholders)
+        missing = [name for name, value in values if value is None]
+        assert not missing, f"No value for {', '.join('$' + name for name in missing)} used in {self.name}"
+        return values
+
+    def render(self, values: Tuple[Tuple[str, str], ...]) -> str:
+        return self.template.substitute(dict(values))
+
+
+# Compiled templates by content hash, shared by all experiments
+_templates: Dict[str, SpecTemplate] = {}
+# Rendered specs by content hash and variable values
+_rendered: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], str] = {}
+_lock = threading.Lock()
+
+
+def load_template(spec_file: Path) -> Tuple[str, SpecTemplate]:
+    """Reads and compiles a spec file. Files with the same content are only compiled once."""
+    content = spec_file.read_bytes()
+    key = hashlib.blake2b(content, digest_size=16).hexdigest()
+    with _lock:
+        template = _templates.get(key)
+    if template is None:
+        template = SpecTemplate(content.decode(), spec_file.name)
+        with _lock:
+            _templates[key] = template
+    return key, template
+
+
+def spec_variables(context: ExperimentContext) -> SpecVariables:
+    """The variables available in spec files (docker side paths)."""
+    return {
+        'project': lambda: context.project,
+        'experiment': lambda: context.experiment,
+        'dataset': lambda: context.docker_paths.dataset_dir.as_posix(),
+        'tfrecords': lambda: context.docker_paths.subset_tfrecords_dir.as_posix(),
+        'pretrained_model': lambda: context.docker_paths.pretrained_model_file.as_posix() if context.docker_paths.has_pretrained_model else None
+    }
+
+
+def render_spec(context: ExperimentContext, spec_file: Path) -> str:
+    """Replaces the placeholders of a tao spec file with the values of the experiment."""
+    key, template = load_template(spec_file)
+    values = template.values(spec_variables(context))
+    with _lock:
+        spec = _rendered.get((key, values))
+    if spec is None:
+        spec = template.render(values)
+        with _lock:
+            _rendered[(key, values)] = spec
+    return spec
+
+
+def compile_spec(context: ExperimentContext, spec_file: Path, compiled_spec_file: Path) -> str:
+    """Renders the spec file to 'compiled_spec_file'.
+
+    The file is only written if its content changes, which keeps its mtime stable for up-to-date checks."""
+    with span('compile_spec', spec=spec_file.as_posix()) as counters:
+        spec = render_spec(context, spec_file)
+        content = spec.encode()
+        try:
+            unchanged = compiled_spec_file.stat().st_size == len(content) and compiled_spec_file.read_bytes() == content
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            compiled_spec_file.write_bytes(content)
+        counters['written'] = not unchanged
+    return spec
+
+
+def spec_value(spec: str, field: str) -> Optional[str]:
+    """The value of the first scalar 'field: value' in a rendered spec (quotes removed), None if the field is not set."""
+    match = re.search(r'\b' + re.escape(field) + r'\s*:\s*("[^"]*"|[^\s{}]+)', spec)
+    return match.group(1).strip('"') if match else None
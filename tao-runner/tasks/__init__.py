@@ -1,8 +1,34 @@
-from . import split, convert, train, export
+"""The tasks of the command line, one module per task.
+
+Each task module provides 'run(context, **kwargs)', called for every experiment with the parsed arguments, or
+'run_all(contexts, scheduler, **kwargs)' to schedule the experiments itself. 'setup(**kwargs)' runs once before,
+'query(db, **kwargs)' replaces both for tasks answered from the run database alone (no project is loaded).
+
+Optional module attributes:
+- uses_gpu: the jobs get a slice of the configured gpus (see scheduler.Scheduler).
+- modifies_dataset: the task writes into the dataset dir, so no two of its jobs run on the same dataset at once.
+- spec_template: file name of the spec template in specs/<experiment> the task renders. Its hash is recorded with
+  each run and marks the run stale once it changes (see runs.RunDatabase).
+- records_metrics: the final metrics of the train.log are recorded with each run.
+
+Pipeline stages (see pipeline) additionally provide:
+- depends_on: the tasks that have to run before.
+- fingerprint(context, **kwargs): the inputs of the task, None if they are missing. The stage is skipped while
+  they are unchanged since its last successful run.
+- outputs(context, **kwargs): the files and directories the task produces.
+"""
+from . import split, convert, train, export, pipeline, metrics, fetch_models, checkpoints, stats, status, history
 
 known_tasks = {
     'split': split,
     'convert': convert,
     'train': train,
-    'export': export
+    'export': export,
+    'run-pipeline': pipeline,
+    'metrics': metrics,
+    'fetch-models': fetch_models,
+    'checkpoints': checkpoints,
+    'stats': stats,
+    'status': status,
+    'history': history
 }
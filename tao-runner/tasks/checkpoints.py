@@ -0,0 +1,34 @@
+from typing import Optional
+
+from ..checkpoints import CheckpointIndex
+from ..context import ExperimentContext
+from ..output import format_table
+from .metrics import metrics_log
+
+
+def checkpoint_index(context: ExperimentContext) -> CheckpointIndex:
+    return CheckpointIndex(context.local_paths.model_dir.joinpath("weights"),
+                           context.local_paths.model_dir.joinpath("checkpoints.json"), metrics_log(context))
+
+
+def run(context: ExperimentContext, select: Optional[str] = None, prune: bool = False, **kwargs):
+    """Lists the checkpoints of the experiment with their metrics, marking the selected ones."""
+    assert not prune or select, "--prune requires --select, to know which checkpoints to keep"
+    index = checkpoint_index(context)
+    checkpoints = index.update()
+    assert checkpoints, f"No checkpoints in {index.weights_dir}"
+
+    selected = [checkpoint for selector in select.split(',') for checkpoint in index.select(selector)] if select else []
+    selected_names = {checkpoint.name for checkpoint in selected}
+
+    metrics = index.metrics_log.metrics
+    rows = [('', 'epoch', 'checkpoint', 'MiB', *metrics)]
+    for checkpoint in checkpoints:
+        rows.append(('*' if checkpoint.name in selected_names else '', str(checkpoint.epoch), checkpoint.name,
+                     f"{checkpoint.size / 2**20:.1f}",
+                     *('-' if checkpoint.metrics.get(name) is None else f"{checkpoint.metrics[name]:g}" for name in metrics)))
+    print(format_table(rows))
+
+    if prune:
+        deleted, size = index.prune(selected)
+        print(f"Pruned {deleted} checkpoints ({size / 2**20:.1f} MiB), kept the selected and the last one")
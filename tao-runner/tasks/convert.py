@@ -1,79 +1,299 @@
-import subprocess
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from shutil import rmtree
+from typing import Any, Dict, List, Optional, Set
 
-from ..context import ExperimentContext
+from ..cache import OutputCache
+from ..context import CONVERT_SPEC, ExperimentContext
+from ..fileutils import FileMaterializer, hash_file, materialize_files, write_atomic
+from ..kitti import KittiReport, check_kitti, create_kitti_dir, manifest_fingerprint
+from ..manifest import stat_file
+from ..output import keep_output_prefix
+from ..process import run_tao, share_exit_codes
+from ..spec import compile_spec, render_spec
+from .split import kitti_set_files
 
+modifies_dataset = True
+spec_template = CONVERT_SPEC
+depends_on = ['split']
 
-# Datumaro does not export label files for 'background' images, which do not contain any object to be detected.
-# TAO expects kitti label files to have 15 columns, but kitti has 16 originally (https://github.com/NVIDIA/DIGITS/issues/992)
 
+def kitti_dirs_in_spec(context: ExperimentContext, spec: str) -> List[Path]:
+    """Resolves the kitti root directories referenced by a compiled convert spec to local paths."""
+    docker_dataset_dir = context.docker_paths.dataset_dir.as_posix()
+    kitti_dirs = []
+    for match in re.finditer(r'root_directory_path\s*:\s*"([^"]+)"', spec):
+        path = match.group(1).rstrip('/')
+        if path == docker_dataset_dir or path.startswith(docker_dataset_dir + '/'):
+            kitti_dirs.append(context.local_paths.dataset_dir.joinpath(
+                path[len(docker_dataset_dir):].lstrip('/')))
+    return kitti_dirs
 
-def check_kitti(kitti_dir: Path):
-    assert kitti_dir.exists(), f"The directory {kitti_dir} does not exist"
 
-    images_dir = kitti_dir.joinpath("image_2")
-    labels_dir = kitti_dir.joinpath("label_2")
-    images = list(
-        images_dir.glob('*.jpg')) + list(images_dir.glob('*.png')) + list(images_dir.glob("*.jpeg"))
-    labels = list(labels_dir.glob('*.txt'))
+def fingerprint(context: ExperimentContext, shards: int = 1, **kwargs) -> Optional[Dict[str, Any]]:
+    if not context.local_paths.convert_spec_file.is_file():
+        return None
+    datasets = {}
+    for kitti_dir in kitti_dirs_in_spec(context, render_spec(context, context.local_paths.convert_spec_file)):
+        datasets[kitti_dir.name] = manifest_fingerprint(kitti_dir)
+        if datasets[kitti_dir.name] is None:
+            return None
+    return {'head': context.config.head, 'spec': hash_file(context.local_paths.convert_spec_file), 'datasets': datasets,
+            'shards': shards}
 
-    assert len(images) > 0, f"No samples found in dataset {kitti_dir}"
 
-    if len(labels) <= len(images):
-        missing_files = [file.stem for file in labels if file not in images]
-        assert f"Found {len(labels)} label files, but only {len(images)} images. Missing:\n" + \
-            '\n'.join(missing_files)
+def outputs(context: ExperimentContext, **kwargs) -> List[Path]:
+    return [context.local_paths.subset_tfrecords_dir]
 
-    print(f"Images: {len(images)}, labels: {len(labels)}")
 
-    for image in images:
-        label_file = labels_dir.joinpath(image.with_suffix('.txt').name)
-        if not label_file.exists():
-            with open(label_file, 'w') as r:
-                r.write('')
-                print(f"Created empty label file {label_file.name}")
+# Prefix of the tfrecord files (-o of dataset_convert)
+TFRECORD_PREFIX = "tfrecord"
+SHARDS_FILENAME = ".shards.json"
+
+
+def shard_of(stem: str, shards: int) -> int:
+    """Shard of an image. Depends on the name only, so adding images does not move the others to another shard."""
+    return int.from_bytes(hashlib.blake2b(stem.encode(), digest_size=8).digest(), 'big') % shards
+
+
+def plan_shards(report: KittiReport, shards: int) -> List[List[str]]:
+    """The image stems of each shard."""
+    plan: List[List[str]] = [[] for _ in range(shards)]
+    for stem in sorted(report.images):
+        plan[shard_of(stem, shards)].append(stem)
+    return plan
+
+
+def shard_fingerprint(report: KittiReport, stems: List[str], spec: str) -> str:
+    """Hash of the spec and the names and stats of the images and labels of a shard."""
+    digest = hashlib.blake2b(spec.encode(), digest_size=16)
+    for stem in stems:
+        label_file = report.labels.get(stem)
+        digest.update(json.dumps([report.images[stem].name, *stat_file(report.images[stem]),
+                                  *(stat_file(label_file) if label_file else [])]).encode())
+    return digest.hexdigest()
+
+
+def docker_path(context: ExperimentContext, path: Path) -> Path:
+    """The docker side path of a local path inside the dataset dir."""
+    return context.docker_paths.dataset_dir.joinpath(path.relative_to(context.local_paths.dataset_dir))
+
+
+def read_shards(output_dir: Path) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads(output_dir.joinpath(SHARDS_FILENAME).read_bytes())
+    except (OSError, ValueError):
+        return None
+
+
+def convert_shard(context: ExperimentContext, spec: str, kitti_dir: Path, report: KittiReport, index: int, stems: List[str],
+                  output_dir: Path) -> List[str]:
+    """Converts the images of one shard and moves the tfrecords into 'output_dir'. Returns their names there.
+
+    The shard is a KITTI dir of hardlinks to the images and labels inside 'output_dir', converted with a
+    copy of the spec pointing to it. The tfrecords are renamed to '<prefix>-part-<index>...', so the shards do not collide."""
+    shard_name = f".shard-{index:03d}"
+    local_shard_dir = output_dir.joinpath(shard_name)
+    docker_shard_dir = docker_path(context, local_shard_dir)
+    if local_shard_dir.exists():
+        rmtree(local_shard_dir)
+
+    kitti_shard_dir = local_shard_dir.joinpath("kitti")
+    create_kitti_dir(kitti_shard_dir)
+    result = materialize_files(kitti_set_files(kitti_dir, kitti_shard_dir, [report.images[stem] for stem in stems]),
+                               FileMaterializer('hardlink', root=context.local_paths.project_dir.parent))
+    assert not result.errors, f"Failed to create {len(result.errors)} files of shard {index}"
+
+    docker_kitti_dir = docker_path(context, kitti_dir)
+    shard_spec = re.sub(r'(root_directory_path\s*:\s*)"' + re.escape(docker_kitti_dir.as_posix()) + r'/?"',
+                        lambda match: f'{match.group(1)}"{docker_shard_dir.joinpath("kitti").as_posix()}"', spec)
+    write_atomic(local_shard_dir.joinpath("convert.txt"), shard_spec)
+
+    print(f"Converting shard {index} ({len(stems)} images)")
+    shard_output_dir = local_shard_dir.joinpath("output")
+    shard_output_dir.mkdir()
+    run_tao([context.config.head, "dataset_convert",
+             "-d", docker_shard_dir.joinpath("convert.txt").as_posix(),
+             "-o", docker_shard_dir.joinpath("output", TFRECORD_PREFIX).as_posix()],
+            log_file=local_shard_dir.joinpath("convert.stdout.log"))
+
+    files = []
+    for file in sorted(shard_output_dir.iterdir()):
+        name = file.name
+        if name.startswith(TFRECORD_PREFIX):
+            name = f"{TFRECORD_PREFIX}-part-{index:03d}{name[len(TFRECORD_PREFIX):]}"
         else:
-            with open(label_file, 'r') as r:
-                for line in r.readlines():
-                    row = line.strip().split(" ")
-                    if len(row) > 15:
-                        print(
-                            f"The file {label_file.name} has {len(row)} fields. Saving first 15")
-                        new_label = str.join(" ", row[:15])
-                        with open(label_file, 'w') as w:
-                            w.write(new_label)
-    print(f"Checked labels for {len(images)} images. All good.")
-
-
-def run(context: ExperimentContext, overwrite: bool = False, **kwargs):
+            name = f"part-{index:03d}-{name}"
+        os.replace(file, output_dir.joinpath(name))
+        files.append(name)
+    rmtree(local_shard_dir)
+    return files
+
+
+def convert_sharded(context: ExperimentContext, spec: str, kitti_dir: Path, report: KittiReport, shards: int, shard_jobs: int,
+                    output_dir: Path):
+    """Converts the dataset in 'shards' parts into 'output_dir', up to 'shard_jobs' at once. Shards whose files and spec
+    did not change since their last conversion into 'output_dir' (see SHARDS_FILENAME) are kept."""
+    state_file = output_dir.joinpath(SHARDS_FILENAME)
+    state = read_shards(output_dir) or {}
+    plan = plan_shards(report, shards)
+    fingerprints = [shard_fingerprint(report, stems, spec) for stems in plan]
+    lock = threading.Lock()
+
+    # Shards of a previous run with more shards
+    for index in [index for index in state if int(index) >= shards]:
+        for name in state.pop(index)['files']:
+            output_dir.joinpath(name).unlink(missing_ok=True)
+
+    dirty = []
+    for index, stems in enumerate(plan):
+        previous = state.get(str(index))
+        if previous and previous['fingerprint'] == fingerprints[index] and \
+                all(output_dir.joinpath(name).exists() for name in previous['files']):
+            continue
+        dirty.append(index)
+    print(f"{len(dirty)} of {shards} shards changed")
+
+    keep_prefix, share_codes = keep_output_prefix(), share_exit_codes()
+
+    def convert(index: int):
+        keep_prefix()
+        share_codes()
+        previous = state.get(str(index))
+        for name in previous['files'] if previous else []:
+            output_dir.joinpath(name).unlink(missing_ok=True)
+        files = convert_shard(context, spec, kitti_dir, report, index, plan[index], output_dir) if plan[index] else []
+        with lock:
+            state[str(index)] = {'fingerprint': fingerprints[index], 'files': files}
+            write_atomic(state_file, json.dumps(state, indent=2, sort_keys=True))
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, shard_jobs)) as executor:
+        futures = [executor.submit(convert, index) for index in dirty]
+        for index, future in zip(dirty, futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(f"{index} ({e})")
+    write_atomic(state_file, json.dumps(state, indent=2, sort_keys=True))
+    assert not failed, f"Converting shards failed: {', '.join(failed)}"
+
+
+# Cache keys converted by this invocation (see run)
+_converted: Set[str] = set()
+
+
+def conversion_key(context: ExperimentContext, spec: str, reports: List[KittiReport], shards: int) -> str:
+    """Content address of a conversion: the rendered spec, the head, the manifests of the converted datasets and the shards."""
+    data = json.dumps({'head': context.config.head, 'spec': spec, 'shards': shards,
+                       'datasets': [report.fingerprint for report in reports]}, sort_keys=True)
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def linked_keys(context: ExperimentContext, cache: OutputCache) -> List[str]:
+    """The cache entries the tfrecords dirs of the dataset (of all experiments) link to."""
+    keys = []
+    with os.scandir(context.local_paths.dataset_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith("tfrecords_"):
+                key = cache.linked_key(Path(entry.path))
+                if key is not None:
+                    keys.append(key)
+    return keys
+
+
+def seed_from(previous_dir: Path, output_dir: Path):
+    """Hardlinks the shards of a previous sharded conversion into 'output_dir', so only the shards that changed are
+    converted again. Shard files are only ever replaced, never written in place, so the previous entry stays intact."""
+    state = read_shards(previous_dir)
+    for shard in state.values():
+        for name in shard['files']:
+            if previous_dir.joinpath(name).exists():
+                os.link(previous_dir.joinpath(name), output_dir.joinpath(name))
+    write_atomic(output_dir.joinpath(SHARDS_FILENAME), json.dumps(state, indent=2, sort_keys=True))
+
+
+def run(context: ExperimentContext, overwrite: bool = False, rebuild_manifest: bool = False, manifest_hashes: bool = False,
+        shards: int = 1, shard_jobs: Optional[int] = None, cache_budget: float = 50.0, **kwargs):
+    """Converts the dataset to tfrecords.
+
+    The tfrecords are stored in the tfrecords cache of the dataset, addressed by a hash of the conversion inputs.
+    'tfrecords_<experiment>' links to the entry, so experiments with the same inputs share one conversion."""
     assert context.local_paths.convert_spec_file.is_file(
     ), f"Converter spec file does not exist at location '{context.local_paths.convert_spec_file}'"
 
-    # TODO: We currently don't know which subset (full, train, val, ...) is being converted, so we cannot check if the dataset is ok.
-    # check_kitti(dataset)
-
-    if context.local_paths.subset_tfrecords_dir.exists():
-        assert overwrite, f"The directory '{context.local_paths.subset_tfrecords_dir.name}' already exists at 'data/'. Use --overwrite to replace the existing data."
-        rmtree(context.local_paths.subset_tfrecords_dir)
-
-    context.local_paths.subset_tfrecords_dir.mkdir()
-
-    with open(context.local_paths.convert_spec_file, 'r') as infile, open(context.local_paths.compiled_convert_spec_file, 'w') as outfile:
-        spec = infile.read()
-        spec = spec.replace("$project", context.project)
-        spec = spec.replace(
-            "$dataset", context.docker_paths.dataset_dir.as_posix())
-        spec = spec.replace(
-            "$tfrecords", context.docker_paths.subset_tfrecords_dir.as_posix())
-        spec = spec.replace("$pretrained_model",
-                            context.docker_paths.pretrained_model_file.as_posix())
-        outfile.write(spec)
-
-    print("Converting dataset to TFRecords...\n")
-    completed = subprocess.run(["tao", context.config.head, "dataset_convert",
-                                "-d", context.docker_paths.compiled_convert_spec_file.as_posix(),
-                                "-o", context.docker_paths.subset_tfrecords_dir.joinpath("tfrecord").as_posix()], check=False, text=True, capture_output=True)
-
-    print("STDOUT:", completed.stdout)
-    print("STDERR:", completed.stderr)
+    tfrecords_dir = context.local_paths.subset_tfrecords_dir
+    cache = OutputCache(context.local_paths.tfrecords_cache_dir)
+    previous_key = cache.linked_key(tfrecords_dir)
+    spec = render_spec(context, context.local_paths.convert_spec_file)
+    if previous_key is None and (tfrecords_dir.exists() or tfrecords_dir.is_symlink()):
+        # Converted before the cache existed
+        assert overwrite, f"The directory '{tfrecords_dir.name}' already exists at 'data/'. Use --overwrite to replace the existing data."
+        if tfrecords_dir.is_symlink():
+            tfrecords_dir.unlink()
+        else:
+            rmtree(tfrecords_dir)
+
+    # The subsets (full, train, val, ...) being converted are only known from the spec
+    kitti_dirs = kitti_dirs_in_spec(context, spec)
+    assert kitti_dirs, "The convert spec has no root_directory_path below $dataset. The tfrecords are cached by the " + \
+        "datasets they are converted from, so the spec has to reference them via $dataset"
+    reports = [check_kitti(kitti_dir, rebuild_manifest=rebuild_manifest, hash_files=manifest_hashes)
+               for kitti_dir in kitti_dirs]
+    key = conversion_key(context, spec, reports, shards)
+
+    def reusable() -> bool:
+        # With --overwrite, each entry is converted again once per invocation, the other experiments reuse it
+        return cache.info(key) is not None and (not overwrite or key in _converted)
+
+    def reuse():
+        print(f"Reusing the tfrecords converted from the same spec and dataset ({cache.info(key)['experiment']}, {key})")
+        cache.touch(key)
+        cache.link(tfrecords_dir, key)
+
+    with cache.lock(key, shared=True):
+        if reusable():
+            reuse()
+            collect(context, cache, cache_budget)
+            return
+
+    # Experiments with the same inputs running at once wait for the first one to convert. Converting again also
+    # waits for the trainings reading the entry (see train.run)
+    with cache.lock(key, blocking=False) as locked:
+        if not locked:
+            print(f"Waiting for the jobs using the tfrecords {key}")
+    with cache.lock(key):
+        if reusable():
+            reuse()
+        else:
+            output_dir = cache.prepare(key)
+            if shards > 1 and previous_key not in (None, key) and not overwrite and read_shards(cache.entry_dir(previous_key)):
+                seed_from(cache.entry_dir(previous_key), output_dir)
+            compile_spec(context, context.local_paths.convert_spec_file,
+                         output_dir.joinpath(context.local_paths.compiled_convert_spec_file.name))
+            if shards > 1:
+                assert len(reports) == 1, f"Sharding requires a single root_directory_path in the convert spec, found {len(reports)}"
+                convert_sharded(context, spec, reports[0].kitti_dir, reports[0], shards,
+                                shard_jobs or max(1, (os.cpu_count() or 1) // 4), output_dir)
+            else:
+                print("Converting dataset to TFRecords...\n")
+                run_tao([context.config.head, "dataset_convert",
+                         "-d", docker_path(context, output_dir.joinpath(context.local_paths.compiled_convert_spec_file.name)).as_posix(),
+                         "-o", docker_path(context, output_dir.joinpath(TFRECORD_PREFIX)).as_posix()],
+                        log_file=output_dir.joinpath("convert.stdout.log"))
+            cache.complete(key, experiment=context.experiment)
+            _converted.add(key)
+            cache.link(tfrecords_dir, key)
+    collect(context, cache, cache_budget)
+
+
+def collect(context: ExperimentContext, cache: OutputCache, cache_budget: float):
+    """Removes the tfrecords no experiment of the dataset links to anymore, once the cache exceeds the budget (GiB)."""
+    removed, freed = cache.collect(int(cache_budget * 2**30), linked_keys(context, cache))
+    if removed:
+        print(f"Removed {removed} unused tfrecords from the cache ({freed / 2**20:.1f} MiB)")
@@ -1,47 +1,158 @@
-import subprocess
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
-from ..context import ExperimentContext
-
-
-def run(context: ExperimentContext, **kwargs):
-    model_name = context.config.export_model
-    local_model_path = Path(context.local_paths.model_dir.joinpath(
-        "weights", model_name + ".tlt"))
-    assert local_model_path.exists(
-    ), f"Model at {local_model_path} does not exist"
-
-    print(
-        f"Exporting {model_name}, project: {context.project}, experiment: {context.experiment}")
-    log_file = context.local_paths.model_dir.joinpath("export.log").as_posix()
-    print(f"See {log_file} for training progress")
-
-    data_type = context.config.export_type
-    completed = subprocess.run(["tao", context.config.head, "export",
-                                "-m", context.docker_paths.model_dir.joinpath(
-                                    "weights", model_name + ".tlt").as_posix(),
-                                "-k", context.config.model_key,
-                                "-e", context.docker_paths.specs_dir.as_posix(),
-                                "-o", context.docker_paths.model_dir.joinpath(
-                                    "export", f"{model_name}_{data_type}.etlt").as_posix(),
-                                "--data_type", data_type,
-                                "--gen_ds_config",
-                                "--gpu_index", context.tao.gpus_indices,
-                                "--log_file", context.docker_paths.model_dir.joinpath("export.log").as_posix()], check=False, text=True, capture_output=True)
-
-    print("STDOUT:", completed.stdout)
-    print("STDERR:", completed.stderr)
-
-    # -o Seems to be dependent on the Model. DSSD: NMS
-    # d is the dimension of the input. Model dependent!
-    tao_converter_command = "tao-converter \\\n" + \
-                            f"\t\t-d 3,300,300\\\n" + \
-                            f"\t\t-o NMS \\\n" + \
-                            f"\t\t-k {context.config.model_key} \\\n" + \
-                            f"\t\t-e export/{model_name}_{data_type}.fp16.engine \\\n" + \
-                            f"\t\t-t {data_type} \\\n" + \
-                            f"\t\t-m 1 \\\n" + \
-                            f"\t\texport/{model_name}_{data_type}.etlt"
-
-    with open(context.local_paths.model_dir.joinpath("generate_trt_engine.sh"), 'w') as outfile:
-        outfile.write(tao_converter_command)
+from ..checkpoints import is_selector, select_checkpoints
+from ..context import TRAIN_SPEC, ExperimentContext
+from ..fileutils import write_atomic
+from ..manifest import stat_file
+from ..output import keep_output_prefix
+from ..process import run_tao, share_exit_codes
+from ..spec import render_spec, spec_value
+from .checkpoints import checkpoint_index
+
+uses_gpu = True
+spec_template = TRAIN_SPEC
+depends_on = ['train']
+
+# Per head: the output nodes of the exported model and the spec fields holding the input dims (channels, height, width)
+EXPORT_HEADS: Dict[str, Tuple[str, Tuple[str, str, str]]] = {
+    'ssd': ('NMS', ('output_channel', 'output_height', 'output_width')),
+    'dssd': ('NMS', ('output_channel', 'output_height', 'output_width')),
+    'retinanet': ('NMS', ('output_channel', 'output_height', 'output_width')),
+    'yolo_v3': ('BatchedNMS', ('output_channel', 'output_height', 'output_width')),
+    'yolo_v4': ('BatchedNMS', ('output_channel', 'output_height', 'output_width')),
+    'yolo_v4_tiny': ('BatchedNMS', ('output_channel', 'output_height', 'output_width')),
+    'detectnet_v2': ('output_cov/Sigmoid,output_bbox/BiasAdd',
+                     ('output_image_channel', 'output_image_height', 'output_image_width')),
+    # The channels follow from 'image_type' (RGB / GRAYSCALE)
+    'faster_rcnn': ('NMS', ('image_type', 'height', 'width')),
+}
+IMAGE_TYPE_CHANNELS = {'RGB': '3', 'GRAYSCALE': '1'}
+
+
+def export_combinations(context: ExperimentContext, models: Optional[str] = None, data_types: Optional[str] = None) -> List[Tuple[str, str]]:
+    """(model, data type) pairs to export. 'models' / 'data_types' (comma separated) override the experiments.yml.
+
+    Models can also be checkpoint selectors ('best', 'last', 'top-<k>', see checkpoints.SELECTOR_PATTERN)."""
+    model_names = models.split(',') if models else context.config.export_models
+    if any(is_selector(name) for name in model_names):
+        model_names = select_checkpoints(checkpoint_index(context), model_names)
+    types = data_types.split(',') if data_types else context.config.export_types
+    return [(model_name, data_type) for model_name in model_names for data_type in types]
+
+
+def fingerprint(context: ExperimentContext, models: Optional[str] = None, data_types: Optional[str] = None, **kwargs) -> Optional[Dict[str, Any]]:
+    model_files = [context.local_paths.model_dir.joinpath("weights", model_name + ".tlt")
+                   for model_name in dict.fromkeys(model_name for model_name, _ in export_combinations(context, models, data_types))]
+    if not all(model_file.is_file() for model_file in model_files):
+        return None
+    return {'head': context.config.head, 'model_key': context.config.model_key,
+            'combinations': export_combinations(context, models, data_types),
+            'models': [[model_file.name, *stat_file(model_file)] for model_file in model_files]}
+
+
+def outputs(context: ExperimentContext, models: Optional[str] = None, data_types: Optional[str] = None, **kwargs) -> List[Path]:
+    export_dir = context.local_paths.model_dir.joinpath("export")
+    return [file for model_name, data_type in export_combinations(context, models, data_types)
+            for file in (export_dir.joinpath(f"{model_name}_{data_type}.etlt"),
+                         export_dir.joinpath(f"{model_name}_{data_type}.generate_trt_engine.sh"))]
+
+
+def input_dims(head: str, spec: str) -> Tuple[str, str, str]:
+    """The input dims (channels, height, width) of the model, read from its train spec."""
+    assert head in EXPORT_HEADS, f"Exporting '{head}' models is not supported. Supported heads: {', '.join(EXPORT_HEADS)}"
+    dims = []
+    for field in EXPORT_HEADS[head][1]:
+        value = spec_value(spec, field)
+        assert value is not None, f"'{field}' is not set in the train spec"
+        dims.append(IMAGE_TYPE_CHANNELS.get(value, value) if field == 'image_type' else value)
+    return dims[0], dims[1], dims[2]
+
+
+def converter_script(context: ExperimentContext, name: str, data_type: str, dims: Tuple[str, str, str]) -> str:
+    """Shell script generating the TensorRT engine of an exported model with tao-converter (paths relative to the script)."""
+    lines = ["tao-converter",
+             f"-d {','.join(dims)}",
+             f"-o {EXPORT_HEADS[context.config.head][0]}",
+             f"-k {context.config.model_key}",
+             f"-e {name}.engine",
+             f"-t {data_type}",
+             "-m 1"]
+    if data_type == 'int8':
+        lines.append(f"-c {name}.cal")
+    lines.append(f"{name}.etlt")
+    return "#!/bin/sh\ncd \"$(dirname \"$0\")\"\n" + " \\\n\t\t".join(lines) + "\n"
+
+
+def export_model(context: ExperimentContext, model_name: str, data_type: str, gpu_index: str, dims: Tuple[str, str, str],
+                 overwrite: bool = False) -> str:
+    """Exports one model with one data type and writes its converter script. Returns 'exported' or 'up-to-date'."""
+    name = f"{model_name}_{data_type}"
+    local_export_dir = context.local_paths.model_dir.joinpath("export")
+    docker_export_dir = context.docker_paths.model_dir.joinpath("export")
+    model_file = context.local_paths.model_dir.joinpath("weights", model_name + ".tlt")
+    etlt_file = local_export_dir.joinpath(name + ".etlt")
+
+    script_file = local_export_dir.joinpath(name + ".generate_trt_engine.sh")
+    local_export_dir.mkdir(parents=True, exist_ok=True)
+    write_atomic(script_file, converter_script(context, name, data_type, dims))
+    os.chmod(script_file, 0o755)
+
+    if not overwrite and etlt_file.is_file() and etlt_file.stat().st_mtime_ns > model_file.stat().st_mtime_ns:
+        return 'up-to-date'
+
+    command = [context.config.head, "export",
+               "-m", context.docker_paths.model_dir.joinpath("weights", model_name + ".tlt").as_posix(),
+               "-k", context.config.model_key,
+               "-e", context.docker_paths.compiled_train_spec_file.as_posix(),
+               "-o", docker_export_dir.joinpath(name + ".etlt").as_posix(),
+               "--data_type", data_type,
+               "--gen_ds_config",
+               "--gpu_index", gpu_index,
+               "--log_file", docker_export_dir.joinpath(name + ".log").as_posix()]
+    if data_type == 'int8':
+        assert context.local_paths.subset_val_dir.joinpath("image_2").is_dir(), \
+            f"int8 export calibrates on the val subset, but '{context.local_paths.subset_val_dir}' does not exist"
+        command += ["--cal_image_dir", context.docker_paths.subset_val_dir.joinpath("image_2").as_posix(),
+                    "--cal_cache_file", docker_export_dir.joinpath(name + ".cal").as_posix()]
+
+    print(f"Exporting {name} on gpu {gpu_index}. See {local_export_dir.joinpath(name + '.log').as_posix()} for export progress")
+    run_tao(command, log_file=local_export_dir.joinpath(name + ".stdout.log"),
+            tail_file=local_export_dir.joinpath(name + ".log"))
+    return 'exported'
+
+
+def run(context: ExperimentContext, models: Optional[str] = None, data_types: Optional[str] = None, parallel: int = 2,
+        overwrite: bool = False, **kwargs):
+    combinations = export_combinations(context, models, data_types)
+    for model_name in dict.fromkeys(model_name for model_name, _ in combinations):
+        model_file = context.local_paths.model_dir.joinpath("weights", model_name + ".tlt")
+        assert model_file.exists(), f"Model at {model_file} does not exist"
+
+    # The spec the model was trained with, compiled by the train task
+    spec_file = context.local_paths.compiled_train_spec_file
+    spec = spec_file.read_text() if spec_file.is_file() else render_spec(context, context.local_paths.train_spec_file)
+    dims = input_dims(context.config.head, spec)
+
+    print(f"Exporting {len(combinations)} models, project: {context.project}, experiment: {context.experiment}")
+    gpu_indices = context.tao.gpu_indices.split(',')
+    keep_prefix, share_codes = keep_output_prefix(), share_exit_codes()
+
+    def export(i: int, model_name: str, data_type: str) -> str:
+        keep_prefix()
+        share_codes()
+        return export_model(context, model_name, data_type, gpu_indices[i % len(gpu_indices)], dims, overwrite)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        futures = [executor.submit(export, i, model_name, data_type)
+                   for i, (model_name, data_type) in enumerate(combinations)]
+        for (model_name, data_type), future in zip(combinations, futures):
+            try:
+                print(f"{model_name}_{data_type}: {future.result()}")
+            except Exception as e:
+                failed.append(f"{model_name}_{data_type} ({e})")
+
+    assert not failed, f"Export failed for {', '.join(failed)}"
@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from shutil import rmtree
+from time import sleep
+from typing import Any, Dict, List, Tuple
+
+from ..context import ExperimentContext, forget_dir
+from ..fileutils import write_atomic
+from ..process import run_process
+from ..scheduler import Scheduler
+
+INDEX_FILENAME = '.index.json'
+INDEX_VERSION = 1
+# NGC organization / team of the TAO pretrained models
+NGC_PREFIX = 'nvidia/tao/'
+
+
+def model_files(model_dir: Path) -> Dict[str, int]:
+    """Name -> size of the files in a model directory (empty if it does not exist)."""
+    try:
+        with os.scandir(model_dir) as entries:
+            return {entry.name: entry.stat().st_size for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return {}
+
+
+def has_weights(files: Dict[str, int]) -> bool:
+    return any(name.endswith('.hdf5') for name in files)
+
+
+class ModelIndex:
+    """The pretrained models that were fetched completely, stored in 'repositories/.index.json'.
+
+    Entries are keyed by '<repository>:<backbone>' and hold the files (name -> size) of the model directory."""
+
+    def __init__(self, repositories_dir: Path):
+        self.file = repositories_dir.joinpath(INDEX_FILENAME)
+        self.models: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        try:
+            index = json.loads(self.file.read_bytes())
+        except (OSError, ValueError):
+            return
+        if index.get('version') == INDEX_VERSION:
+            self.models = index['models']
+
+    def is_complete(self, key: str, model_dir: Path) -> bool:
+        """Whether the indexed files of the model are all present with their indexed size."""
+        with self._lock:
+            entry = self.models.get(key)
+        if entry is None:
+            return False
+        files = model_files(model_dir)
+        return all(files.get(name) == size for name, size in entry['files'].items())
+
+    def add(self, key: str, model_dir: Path):
+        with self._lock:
+            self.models[key] = {'files': model_files(model_dir),
+                                'fetched': datetime.now().isoformat(timespec='seconds')}
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            write_atomic(self.file, json.dumps(
+                {'version': INDEX_VERSION, 'models': self.models}, indent=2, sort_keys=True))
+
+
+def referenced_models(contexts: List[ExperimentContext]) -> Dict[str, Tuple[str, str, Path]]:
+    """'<repository>:<backbone>' -> (repository, backbone, local model dir) of each pretrained model the experiments use."""
+    models = {}
+    for context in contexts:
+        config = context.config
+        models.setdefault(f"{config.repository}:{config.backbone}",
+                          (config.repository, config.backbone, context.local_paths.pretrained_model_dir))
+    return models
+
+
+def download_model(ngc: str, repository: str, backbone: str, model_dir: Path, log_file: Path):
+    """Downloads a model with the ngc cli into a staging dir, which is moved to 'model_dir' once it is complete.
+
+    Interrupted downloads therefore never leave a partial model in 'model_dir'."""
+    staging_dir = model_dir.with_name(f".{model_dir.name}.download")
+    if staging_dir.exists():
+        rmtree(staging_dir)
+    staging_dir.mkdir(parents=True)
+    try:
+        returncode = run_process([ngc, 'registry', 'model', 'download-version', '--dest', staging_dir.as_posix(),
+                                  f"{NGC_PREFIX}{repository}:{backbone}"], log_file=log_file, echo=False)
+        assert returncode == 0, f"ngc failed with exit code {returncode}. See {log_file}"
+
+        # ngc downloads into '<dest>/<repository>_v<version>'
+        downloaded = [entry for entry in staging_dir.iterdir() if entry.is_dir()]
+        assert len(downloaded) == 1, f"Expected a single model dir from ngc, got {len(downloaded)}. See {log_file}"
+        assert has_weights(model_files(downloaded[0])), f"The download contains no *.hdf5 file. See {log_file}"
+
+        if model_dir.exists():
+            rmtree(model_dir)
+        os.replace(downloaded[0], model_dir)
+        forget_dir(model_dir)
+    finally:
+        rmtree(staging_dir, ignore_errors=True)
+
+
+def fetch_model(index: ModelIndex, key: str, repository: str, backbone: str, model_dir: Path, ngc: str = 'ngc',
+                retries: int = 3, retry_delay: float = 5.0, force: bool = False) -> str:
+    """Makes sure the model is present in 'model_dir'. Returns what was done ('cached', 'indexed' or 'downloaded')."""
+    if not force:
+        if index.is_complete(key, model_dir):
+            return 'cached'
+        if key not in index.models and has_weights(model_files(model_dir)):
+            # Downloaded before the index existed
+            index.add(key, model_dir)
+            return 'indexed'
+
+    log_file = index.file.parent.joinpath('.logs', f"{model_dir.name}.log")
+    for attempt in range(retries + 1):
+        try:
+            download_model(ngc, repository, backbone, model_dir, log_file)
+            break
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay * 2 ** attempt
+            print(f"{key}: {e}. Retrying in {delay:.0f}s ({attempt + 1}/{retries})")
+            sleep(delay)
+
+    index.add(key, model_dir)
+    return 'downloaded'
+
+
+def run_all(contexts: List[ExperimentContext], scheduler: Scheduler, workers: int = 4, retries: int = 3,
+            ngc: str = 'ngc', force: bool = False, **kwargs) -> bool:
+    """Fetches the pretrained models of all experiments in parallel. Models in the index are not downloaded again."""
+    assert contexts, "No experiments to fetch the pretrained models for"
+    models = referenced_models(contexts)
+    repositories_dir = contexts[0].local_paths.base.joinpath('repositories')
+    index = ModelIndex(repositories_dir)
+    print(f"{len(models)} pretrained models referenced: {', '.join(models)}")
+
+    failed: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(fetch_model, index, key, repository, backbone, model_dir, ngc, retries,
+                                   force=force): key for key, (repository, backbone, model_dir) in models.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                print(f"{key}: {future.result()}")
+            except Exception as e:
+                failed[key] = f"{type(e).__name__}: {e}"
+                print(f"{key}: failed ({failed[key]})")
+
+    if failed:
+        print(f"Failed to fetch {len(failed)} of {len(models)} models: {', '.join(failed)}")
+    return not failed
@@ -0,0 +1,27 @@
+import json
+from typing import List, Optional
+
+from ..output import format_table
+from ..runs import RunDatabase, format_seconds
+
+
+def query(db: RunDatabase, project: Optional[str] = None, experiments: List[str] = (), task: Optional[str] = None,
+          failed: bool = False, limit: int = 50, sql: Optional[str] = None, **kwargs) -> bool:
+    """Prints the most recent runs (newest first), or the result of an SQL query on the run database (--sql)."""
+    if sql:
+        rows = db.query(sql)
+        if rows:
+            print(format_table([tuple(rows[0].keys())] + [tuple(str(value) for value in row) for row in rows]))
+        return True
+
+    rows = db.history(project, experiments, task, failed, limit)
+    table = [('id', 'started', 'project', 'experiment', 'task', 'status', 'exit', 'elapsed', 'config', 'spec', 'artifacts')]
+    for row in rows:
+        table.append((str(row['id']), row['started'], row['project'], row['experiment'], row['task'], row['status'],
+                      '-' if row['exit_code'] is None else str(row['exit_code']), format_seconds(row['seconds']),
+                      (row['config_hash'] or '-')[:8], (row['spec_hash'] or '-')[:8], str(len(json.loads(row['artifacts'] or '[]')))))
+    print(format_table(table) if rows else "No runs recorded")
+    for row in rows:
+        if row['error']:
+            print(f"{row['id']}: {row['error']}")
+    return True
@@ -0,0 +1,72 @@
+from pathlib import Path
+from typing import List
+
+from ..context import ExperimentContext
+from ..scheduler import Scheduler
+from ..train_log import MetricsLog
+
+records_metrics = True
+
+
+def metrics_log(context: ExperimentContext) -> MetricsLog:
+    return MetricsLog(context.local_paths.model_dir.joinpath("train.log"),
+                      context.local_paths.model_dir.joinpath("metrics.state.json"), context.config.head)
+
+
+def run(context: ExperimentContext, formats: str = 'csv', **kwargs):
+    """Extracts the per-epoch metrics from the train.log of the experiment."""
+    log = metrics_log(context)
+    assert log.log_file.is_file(), f"No training log at {log.log_file}"
+
+    outputs = {'csv': context.local_paths.model_dir.joinpath("metrics.csv"),
+               'npy': context.local_paths.model_dir.joinpath("metrics.npy")}
+    requested = formats.split(',')
+    for fmt in requested:
+        assert fmt in outputs, f"Unknown format '{fmt}'. Use one of {', '.join(outputs)}"
+
+    if log.update() or not all(outputs[fmt].exists() for fmt in requested):
+        if 'csv' in requested:
+            log.write_csv(outputs['csv'])
+        if 'npy' in requested:
+            log.write_npy(outputs['npy'])
+
+    rows = log.rows()
+    print(f"{len(rows)} epochs in {log.log_file.name}")
+    for i, name in enumerate(log.metrics, start=1):
+        values = [(row[i], row[0]) for row in rows if row[i] is not None]
+        if values:
+            print(f"{name}: last {values[-1][0]} (epoch {values[-1][1]}), "
+                  f"{'max' if name == 'mAP' else 'min'} {(max if name == 'mAP' else min)(values)[0]}")
+
+
+def plot(contexts: List[ExperimentContext], output_dir: Path):
+    """Plots each metric of all experiments into one chart. Uses the parsed metrics, no log is read again."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    logs = {context.experiment: metrics_log(context) for context in contexts}
+    output_dir.mkdir(parents=True, exist_ok=True)
+    metrics = dict.fromkeys(name for log in logs.values() for name in log.metrics)
+    for name in metrics:
+        plt.clf()
+        for experiment, log in logs.items():
+            if name not in log.metrics:
+                continue
+            i = log.metrics.index(name) + 1
+            points = [(row[0], row[i]) for row in log.rows() if row[i] is not None]
+            if points:
+                plt.plot(*zip(*points), label=experiment)
+        plt.xlabel('epoch')
+        plt.ylabel(name)
+        plt.legend()
+        plt.savefig(output_dir.joinpath(name + ".png"))
+        print(f"Saved {output_dir.joinpath(name + '.png')}")
+
+
+def run_all(contexts: List[ExperimentContext], scheduler: Scheduler, plot_metrics: bool = False, **kwargs) -> bool:
+    succeeded = scheduler.run_task(
+        contexts, lambda context: run(context, **kwargs), uses_gpu=False)
+    if succeeded and plot_metrics:
+        plot(contexts, contexts[0].local_paths.project_dir.joinpath("metrics"))
+    return succeeded
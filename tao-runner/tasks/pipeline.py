@@ -0,0 +1,118 @@
+import hashlib
+import json
+from datetime import datetime
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Dict, List, Optional
+
+from ..context import ExperimentContext
+from ..fileutils import write_atomic
+from ..scheduler import Job, Scheduler
+
+
+def stamp_file(context: ExperimentContext, task: str) -> Path:
+    return context.local_paths.state_dir.joinpath(task + '.json')
+
+
+def read_stamp(context: ExperimentContext, task: str) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads(stamp_file(context, task).read_bytes())
+    except (OSError, ValueError):
+        return None
+
+
+def stage_order(tasks: Dict[str, ModuleType]) -> List[str]:
+    """Orders the tasks, so each task comes after the tasks it depends on."""
+    order: List[str] = []
+
+    def visit(name: str, path: List[str]):
+        assert name not in path, f"Circular task dependency: {' -> '.join(path + [name])}"
+        if name in order:
+            return
+        for dependency in getattr(tasks[name], 'depends_on', []):
+            visit(dependency, path + [name])
+        order.append(name)
+
+    for name, task in tasks.items():
+        if hasattr(task, 'fingerprint'):
+            visit(name, [])
+    return order
+
+
+class Stage:
+    """A task of the pipeline for a single experiment.
+
+    It is up to date, if the fingerprint of its inputs (including the stamps of the tasks it depends on) matches
+    the stamp written after its last successful run and all of its outputs exist."""
+
+    def __init__(self, name: str, task: ModuleType, context: ExperimentContext, args: Dict[str, Any]):
+        self.name = name
+        self.task = task
+        self.context = context
+        self.args = args
+
+    def fingerprint(self) -> Optional[str]:
+        inputs = self.task.fingerprint(self.context, **self.args)
+        if inputs is None:
+            return None
+
+        dependencies = {}
+        for dependency in getattr(self.task, 'depends_on', []):
+            stamp = read_stamp(self.context, dependency)
+            dependencies[dependency] = stamp['fingerprint'] if stamp else None
+        data = json.dumps({'inputs': inputs, 'depends_on': dependencies}, sort_keys=True)
+        return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+    def up_to_date(self) -> bool:
+        stamp = read_stamp(self.context, self.name)
+        if stamp is None or not all(output.exists() for output in self.task.outputs(self.context, **self.args)):
+            return False
+        current = self.fingerprint()
+        return current is not None and current == stamp['fingerprint']
+
+    def write_stamp(self):
+        current = self.fingerprint()
+        if current is None:
+            return
+        file = stamp_file(self.context, self.name)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(file, json.dumps(
+            {'fingerprint': current, 'completed': datetime.now().isoformat(timespec='seconds')}, indent=2))
+
+    def run(self, context: ExperimentContext):
+        print(f"Running stage '{self.name}'")
+        self.task.run(context, **self.args)
+
+
+def run_all(contexts: List[ExperimentContext], scheduler: Scheduler, stages: Optional[str] = None, subset: Optional[str] = None,
+            force: bool = False, **kwargs) -> bool:
+    """Runs the stages for all experiments. Stages that are up to date are skipped, independent stages run in parallel."""
+    from . import known_tasks
+
+    order = stage_order(known_tasks)
+    requested = stages.split(',') if stages else list(order)
+    for name in requested:
+        assert name in order, f"Unknown stage '{name}'. Available stages: {', '.join(order)}"
+    if subset is None and 'split' in requested:
+        assert not stages, "The stage 'split' requires --subset"
+        requested.remove('split')
+
+    args = dict(kwargs, subset=subset)
+    jobs: List[Job] = []
+    for context in contexts:
+        experiment_jobs: Dict[str, Job] = {}
+        for name in order:
+            if name not in requested:
+                continue
+            task = known_tasks[name]
+            stage = Stage(name, task, context, args)
+            depends_on = [experiment_jobs[dependency] for dependency in getattr(task, 'depends_on', [])
+                          if dependency in experiment_jobs]
+            experiment_jobs[name] = Job(context, stage.run, uses_gpu=getattr(task, 'uses_gpu', False),
+                                        name=f"{context.experiment}/{name}", depends_on=depends_on,
+                                        up_to_date=None if force else stage.up_to_date, on_success=stage.write_stamp,
+                                        task_name=name, modifies_dataset=getattr(task, 'modifies_dataset', False))
+        jobs += experiment_jobs.values()
+
+    print(f"Stages: {', '.join(name for name in order if name in requested)}")
+    return scheduler.run(jobs)
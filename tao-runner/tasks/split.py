@@ -1,31 +1,176 @@
+import json
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import random
-from re import T
-from shutil import rmtree, copyfile
-from typing import List
+from shutil import rmtree
+from typing import Any, Dict, List, Optional, Tuple
 from ..context import ExperimentContext
-from .convert import check_kitti
+from ..fileutils import FileMaterializer, MaterializeResult, materialize_files, write_atomic
+from ..kitti import check_kitti, create_kitti_dir, label_classes, manifest_fingerprint
+from ..trace import span
 
+modifies_dataset = True
+depends_on: List[str] = []
 
-def copy_kitti_set(src: Path, dest: Path, img_set: List[Path]):
+
+def fingerprint(context: ExperimentContext, subset: str, val: float = 0.2, seed: int = 0, stratified: bool = False,
+                link_mode: str = 'copy', index_only: bool = False, **kwargs) -> Optional[Dict[str, Any]]:
+    dataset = manifest_fingerprint(context.local_paths.dataset_dir.joinpath(subset))
+    if dataset is None:
+        return None
+    return {'subset': subset, 'val': val, 'seed': seed, 'stratified': stratified,
+            'link_mode': None if index_only else link_mode, 'dataset': dataset}
+
+
+def outputs(context: ExperimentContext, index_only: bool = False, **kwargs) -> List[Path]:
+    index_files = [context.local_paths.split_train_file,
+                   context.local_paths.split_val_file]
+    return index_files if index_only else index_files + [context.local_paths.subset_train_dir, context.local_paths.subset_val_dir]
+
+
+def kitti_set_files(src: Path, dest: Path, img_set: List[Path]) -> List[Tuple[Path, Path]]:
+    """(source, destination) pairs of the images and labels to place into the KITTI directory 'dest'."""
+    pairs = []
     for img_src in img_set:
         label_src = src.joinpath("label_2", img_src.stem + ".txt")
 
         img_dest = dest.joinpath("image_2", img_src.name)
         label_dest = dest.joinpath("label_2", label_src.name)
 
-        copyfile(img_src, img_dest)
-        copyfile(label_src, label_dest)
+        pairs.append((img_src, img_dest))
+        pairs.append((label_src, label_dest))
+    return pairs
+
+
+def copy_kitti_set(src: Path, sets: Dict[Path, List[Path]], materialize: Optional[FileMaterializer] = None, workers: Optional[int] = None) -> MaterializeResult:
+    """Copies (or links) the images of each destination KITTI directory and their labels using a thread pool."""
+    pairs = []
+    for dest, img_set in sets.items():
+        create_kitti_dir(dest)
+        pairs += kitti_set_files(src, dest, img_set)
+
+    return materialize_files(pairs, materialize, workers)
+
 
+def rarest_classes(dataset: Path, images: List[Path], workers: Optional[int] = None) -> Dict[str, str]:
+    """Maps each image to the rarest class among its objects ('' for background images).
 
-def run(context: ExperimentContext, subset: str, val: float = 0.2, overwrite: bool = False, **kwargs):
+    Used as the stratum of the image, so rare classes end up in both subsets."""
+    labels_dir = dataset.joinpath("label_2")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        classes = list(executor.map(lambda image: label_classes(
+            labels_dir.joinpath(image.stem + ".txt")), images))
+
+    frequency = Counter(name for names in classes for name in set(names))
+    return {image.name: min(set(names), key=lambda name: (frequency[name], name)) if names else ''
+            for image, names in zip(images, classes)}
+
+
+def allocate_val(sizes: Dict[str, int], val: float) -> Dict[str, int]:
+    """Number of val images per stratum (given its number of images), adding up to the share 'val' of all images.
+
+    Largest remainder allocation: each stratum gets the integer part of its share, the remaining images go to the
+    strata with the largest fractional parts. Strata with at least 2 images get at least 1 val image (if val > 0),
+    which is taken back from the strata with the smallest fractional parts."""
+    target = int(round(sum(sizes.values()) * val))
+    quotas = {stratum: size * val for stratum, size in sizes.items()}
+    minimum = {stratum: 1 if size >= 2 and val > 0 else 0 for stratum, size in sizes.items()}
+    counts = {stratum: min(max(int(quota), minimum[stratum]), sizes[stratum]) for stratum, quota in quotas.items()}
+
+    # Largest fractional part first, ties by name
+    by_remainder = sorted(sizes, key=lambda stratum: (counts[stratum] - quotas[stratum], stratum))
+    remaining = target - sum(counts.values())
+    for stratum in by_remainder:
+        if remaining <= 0:
+            break
+        if counts[stratum] < sizes[stratum]:
+            counts[stratum] += 1
+            remaining -= 1
+    # The minimums exceeded the target: take back from the strata that got the most above their share
+    while remaining < 0:
+        reducible = [stratum for stratum in reversed(by_remainder) if counts[stratum] > minimum[stratum]]
+        if not reducible:
+            break
+        for stratum in reducible[:-remaining]:
+            counts[stratum] -= 1
+            remaining += 1
+    return counts
+
+
+def split_images(images: List[Path], val: float, seed: int, strata: Optional[Dict[str, str]] = None) -> Tuple[List[Path], List[Path]]:
+    """Deterministically splits the images into train / val. With strata, each stratum is split on its own, the number
+    of val images per stratum is allocated from the total (see allocate_val)."""
+    rng = random.Random(seed)
+    groups: Dict[str, List[Path]] = defaultdict(list)
+    for image in sorted(images):
+        groups[strata[image.name] if strata else ''].append(image)
+    val_counts = allocate_val({stratum: len(group) for stratum, group in groups.items()}, val) if strata else {}
+
+    train_img, val_img = [], []
+    for stratum in sorted(groups):
+        group = groups[stratum]
+        rng.shuffle(group)
+        val_cnt = val_counts[stratum] if strata else int(len(group) * val)
+        train_img += group[:len(group) - val_cnt]
+        val_img += group[len(group) - val_cnt:]
+    return train_img, val_img
+
+
+def read_split(context: ExperimentContext) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads(context.local_paths.split_info_file.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+
+def write_split(context: ExperimentContext, info: Dict[str, Any], train_img: List[Path], val_img: List[Path]):
+    """Writes the index files (image file names of the source subset) and the parameters of the split."""
+    write_atomic(context.local_paths.split_train_file,
+                 ''.join(image.name + "\n" for image in train_img))
+    write_atomic(context.local_paths.split_val_file,
+                 ''.join(image.name + "\n" for image in val_img))
+    write_atomic(context.local_paths.split_info_file,
+                 json.dumps(info, indent=2))
+
+
+def run(context: ExperimentContext, subset: str, val: float = 0.2, overwrite: bool = False, rebuild_manifest: bool = False, manifest_hashes: bool = False,
+        link_mode: str = 'copy', workers: Optional[int] = None, seed: int = 0, stratified: bool = False, index_only: bool = False, **kwargs):
     """Split a KITTI Dataset into train / val subsets."""
     print(f"Splitting subset {subset} into train and val subsets")
 
     dataset = context.local_paths.dataset_dir.joinpath(subset)
 
-    check_kitti(dataset)
-
+    report = check_kitti(dataset, rebuild_manifest=rebuild_manifest,
+                         hash_files=manifest_hashes, workers=workers)
+
+    info = {
+        'subset': subset,
+        'val': val,
+        'seed': seed,
+        'stratified': stratified,
+        'link_mode': None if index_only else link_mode,
+        'dataset': report.fingerprint
+    }
+    subsets_exist = context.local_paths.subset_train_dir.exists(
+    ) and context.local_paths.subset_val_dir.exists()
+    if read_split(context) == info and (index_only or subsets_exist):
+        print(
+            f"Split of subset {subset} with seed {seed} is up to date, nothing to do.")
+        return
+
+    images = report.image_files()
+    with span('split_images', stratified=stratified) as counters:
+        strata = rarest_classes(dataset, images, workers) if stratified else None
+        train_img, val_img = split_images(images, val, seed, strata)
+        counters.update(files=len(images), train=len(train_img), val=len(val_img))
+
+    print("Total {} samples in KITTI training dataset".format(len(images)))
+    print("{} for train and {} for val".format(len(train_img), len(val_img)))
+    if strata:
+        print(f"Stratified by {len(set(strata.values()))} classes")
+
+    # Also with --index-only: the directories of an earlier split would not match the new index files
     if context.local_paths.subset_train_dir.exists():
         assert overwrite, f"The directory '{context.local_paths.subset_train_dir.name}' already exists at 'data/{context.local_paths.dataset_dir.name}'. Use --overwrite to replace the existing data."
         rmtree(context.local_paths.subset_train_dir)
@@ -34,36 +179,20 @@ def run(context: ExperimentContext, subset: str, val: float = 0.2, overwrite: bo
         assert overwrite, f"The directory '{context.local_paths.subset_val_dir.name}' already exists at 'data/{context.local_paths.dataset_dir.name}/'. Use --overwrite to replace the existing data."
         rmtree(context.local_paths.subset_val_dir)
 
-    context.local_paths.subset_train_dir.joinpath(
-        "image_2").mkdir(parents=True, exist_ok=True)
-    context.local_paths.subset_train_dir.joinpath(
-        "label_2").mkdir(parents=True, exist_ok=True)
-
-    context.local_paths.subset_val_dir.joinpath(
-        "image_2").mkdir(parents=True, exist_ok=True)
-    context.local_paths.subset_val_dir.joinpath(
-        "label_2").mkdir(parents=True, exist_ok=True)
-
-    images_dir = dataset.joinpath("image_2")
-    labels_dir = dataset.joinpath("label_2")
-
-    images = list(
-        images_dir.glob('*.jpg')) + list(images_dir.glob('*.png')) + list(images_dir.glob("*.jpeg"))
-
-    total_cnt = len(images)
-    val_cnt = int(total_cnt * val)
-    train_cnt = total_cnt - val_cnt
-
-    random.shuffle(images)
+    if not index_only:
+        print("Copying..." if link_mode == 'copy' else f"Linking ({link_mode})...")
 
-    train_img = images[:train_cnt]
-    val_img = images[train_cnt:]
+        # Symlinks have to resolve inside the projects dir, which is mounted into the tao container
+        materialize = FileMaterializer(
+            link_mode, root=context.local_paths.project_dir.parent)
+        result = copy_kitti_set(dataset, {
+            context.local_paths.subset_train_dir: train_img,
+            context.local_paths.subset_val_dir: val_img
+        }, materialize, workers)
 
-    print("Total {} samples in KITTI training dataset".format(total_cnt))
-    print("{} for train and {} for val".format(train_cnt, val_cnt))
-    print("Copying...")
+        print(result.summary())
+        assert not result.errors, f"Failed to create {len(result.errors)} files"
 
-    copy_kitti_set(dataset,
-                   context.local_paths.subset_train_dir, train_img)
-    copy_kitti_set(dataset,
-                   context.local_paths.subset_val_dir, val_img)
+    write_split(context, info, train_img, val_img)
+    print(
+        f"Wrote {context.local_paths.split_train_file.name} and {context.local_paths.split_val_file.name} to 'data/{context.local_paths.dataset_dir.name}/'")
@@ -0,0 +1,56 @@
+import json
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from ..context import ExperimentContext
+from ..fileutils import write_atomic
+from ..kitti import check_kitti, manifest_fingerprint
+
+modifies_dataset = True
+
+# Written into each KITTI directory, next to its manifest
+STATS_FILENAME = ".stats.json"
+STATS_VERSION = 1
+
+
+def read_stats(kitti_dir: Path, fingerprint: Optional[str], options: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The cached statistics of a KITTI directory, if they were computed from the same samples and options."""
+    if fingerprint is None:
+        return None
+    try:
+        cached = json.loads(kitti_dir.joinpath(STATS_FILENAME).read_bytes())
+    except (OSError, ValueError):
+        return None
+    if cached.get('version') != STATS_VERSION or cached.get('fingerprint') != fingerprint or cached.get('options') != options:
+        return None
+    return cached['stats']
+
+
+def run(context: ExperimentContext, subsets: str = 'full,train,val', workers: Optional[int] = None, anchors: int = 9,
+        overwrite: bool = False, rebuild_manifest: bool = False, manifest_hashes: bool = False, **kwargs):
+    """Prints the label statistics of the subsets of the experiment's dataset. Subsets that do not exist are skipped.
+
+    The statistics are cached in each subset (see STATS_FILENAME) and only computed again once its manifest changed."""
+    from ..label_stats import format_stats, label_stats
+
+    options = {'anchors': anchors}
+    found = False
+    for subset in subsets.split(','):
+        kitti_dir = context.local_paths.dataset_dir.joinpath(subset)
+        if not kitti_dir.joinpath("image_2").is_dir():
+            continue
+        found = True
+
+        # Only stats the files, if nothing changed since the last check
+        stats = None if overwrite or rebuild_manifest else read_stats(kitti_dir, manifest_fingerprint(kitti_dir), options)
+        if stats is None:
+            report = check_kitti(kitti_dir, rebuild_manifest=rebuild_manifest, hash_files=manifest_hashes)
+            stats = label_stats(report, workers, anchors=anchors)
+            write_atomic(kitti_dir.joinpath(STATS_FILENAME), json.dumps(
+                {'version': STATS_VERSION, 'fingerprint': report.fingerprint, 'options': options, 'stats': stats}, indent=1))
+        else:
+            print(f"Unchanged since the statistics were computed ({kitti_dir.joinpath(STATS_FILENAME).as_posix()})")
+
+        print(f"Subset '{subset}' of dataset '{context.config.dataset}':")
+        print(format_stats(stats))
+    assert found, f"None of the subsets {subsets} exist in {context.local_paths.dataset_dir}"
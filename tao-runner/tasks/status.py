@@ -0,0 +1,39 @@
+from typing import List, Optional
+
+from ..output import format_table
+from ..runs import RunDatabase, format_seconds
+
+
+def query(db: RunDatabase, project: Optional[str] = None, experiments: List[str] = (), stale: bool = False,
+          best: Optional[str] = None, by: str = 'backbone', **kwargs) -> bool:
+    """Prints the last run of each task per experiment, or the best value of a metric per group (--best).
+    Answered from the run database only."""
+    if best:
+        rows = db.best(best, by, project, experiments)
+        table = [(by, best, 'epoch', 'experiment', 'started', 'experiments')]
+        table += [(str(row['grouped']), f"{row['best']:g}", str(row['best_epoch']), f"{row['project']}/{row['experiment']}",
+                   row['started'], str(row['experiments'])) for row in rows]
+        print(format_table(table) if rows else f"No runs with '{best}' recorded")
+        return True
+
+    from . import known_tasks
+    # The pipeline tasks, which have inputs that can change
+    outdated = db.stale({name: task.depends_on for name, task in known_tasks.items() if hasattr(task, 'fingerprint')},
+                        {name: task.spec_template for name, task in known_tasks.items() if hasattr(task, 'spec_template')},
+                        project, experiments)
+    rows = db.latest(project, experiments)
+    table = [('project', 'experiment', 'task', 'status', 'started', 'elapsed', 'mAP', 'stale')]
+    for row in rows:
+        key = (row['project'], row['experiment'], row['task'])
+        if stale and key not in outdated:
+            continue
+        status = row['status']
+        if status != 'done' and row['done_id'] is not None:
+            status += ' (done before)'
+        table.append((*key, status, row['started'], format_seconds(row['seconds']),
+                      '-' if row['best_map'] is None else f"{row['best_map']:g}", outdated.get(key, '')))
+    if len(table) == 1:
+        print("No stale tasks" if stale and rows else "No runs recorded")
+    else:
+        print(format_table(table))
+    return True
@@ -1,13 +1,50 @@
 import subprocess
+from contextlib import nullcontext
+from pathlib import Path
 from shutil import rmtree
+from typing import Any, Dict, List, Optional
 
-from ..context import ExperimentContext
+from ..cache import OutputCache
+from ..context import TRAIN_SPEC, ExperimentContext
+from ..fileutils import hash_file
+from ..manifest import stat_file
+from ..process import run_tao
+from ..spec import compile_spec, render_spec
 
+uses_gpu = True
+spec_template = TRAIN_SPEC
+records_metrics = True
+depends_on = ['convert']
 
-def run(context: ExperimentContext, overwrite: bool = False, stop: bool = False, **kwargs):
+
+def fingerprint(context: ExperimentContext, **kwargs) -> Optional[Dict[str, Any]]:
+    if not context.local_paths.train_spec_file.is_file() or not context.local_paths.has_pretrained_model:
+        return None
+    return {'head': context.config.head, 'backbone': context.config.backbone, 'model_key': context.config.model_key,
+            'spec': hash_file(context.local_paths.train_spec_file),
+            'pretrained_model': [context.local_paths.pretrained_model_file.name, *stat_file(context.local_paths.pretrained_model_file)]}
+
+
+def outputs(context: ExperimentContext, **kwargs) -> List[Path]:
+    return [context.local_paths.model_dir.joinpath("weights")]
+
+
+def setup(stop: bool = False, **kwargs):
+    """Runs once before the experiments are scheduled."""
+    # Stop running training, if requested
+    if stop:
+        print("Stopping running tao tasks...")
+        subprocess.run(["tao", "stop", "--all"], check=True,
+                       text=True, capture_output=True)
+
+
+def run(context: ExperimentContext, overwrite: bool = False, **kwargs):
     # Checks to make sure all files are present and we don't override anything
     assert context.local_paths.train_spec_file.is_file(
     ), f"Spec file is not present at location '{context.local_paths.train_spec_file}'"
+    pretrained_model_file = context.docker_paths.pretrained_model_file
+    # Fails on invalid placeholders before anything is deleted
+    render_spec(context, context.local_paths.train_spec_file)
     if not overwrite:
         assert not context.local_paths.model_dir.exists(
         ), f"The model directory '{context.local_paths.model_dir.name}' already exists."
@@ -15,39 +52,26 @@ def run(context: ExperimentContext, overwrite: bool = False, stop: bool = False,
         rmtree(context.local_paths.model_dir)
 
     # Prepare the model directory
-    context.local_paths.model_dir.mkdir(exist_ok=True)
-
-    with open(context.local_paths.train_spec_file, 'r') as infile, open(context.local_paths.model_dir.joinpath(context.local_paths.train_spec_file.name), 'w') as outfile:
-        spec = infile.read()
-        spec = spec.replace("$project", context.project)
-        spec = spec.replace(
-            "$dataset", context.docker_paths.dataset_dir.as_posix())
-        spec = spec.replace(
-            "$tfrecords", context.docker_paths.subset_tfrecords_dir.as_posix())
-        spec = spec.replace("$pretrained_model",
-                            context.docker_paths.pretrained_model_file.as_posix())
-        outfile.write(spec)
+    context.local_paths.model_dir.mkdir(parents=True, exist_ok=True)
 
-    # Stop running training, if requested
-    if stop:
-        print("Stopping running tao tasks...")
-        subprocess.run(["tao", "stop", "--all"], check=True,
-                       text=True, capture_output=True)
+    compile_spec(context, context.local_paths.train_spec_file,
+                 context.local_paths.compiled_train_spec_file)
 
     print("Starting training...")
     print(
-        f"Using pretrained model: {context.config.repository}/{context.docker_paths.pretrained_model_file.name}")
-    log_file = context.local_paths.model_dir.joinpath("train.log").as_posix()
-    print(f"See {log_file} for training progress")
-
-    completed = subprocess.run(["tao", context.config.head, "train",
-                                "--gpus", context.tao.gpus,
-                                "--gpu_index", context.tao.gpu_indices,
-                                "-e", context.docker_paths.model_dir.joinpath(
-                                    context.local_paths.train_spec_file.name).as_posix(),
-                                "-r", context.docker_paths.model_dir.as_posix(),
-                                "-k", context.config.model_key,
-                                "--log_file", context.docker_paths.model_dir.joinpath("train.log").as_posix()], check=False, text=True, capture_output=True)
-
-    print("STDOUT:", completed.stdout)
-    print("STDERR:", completed.stderr)
+        f"Using pretrained model: {context.config.repository}/{pretrained_model_file.name}")
+    log_file = context.local_paths.model_dir.joinpath("train.log")
+    print(f"See {log_file.as_posix()} for training progress")
+
+    # Keeps the tfrecords from being converted again or collected while they are read (see convert.run)
+    cache = OutputCache(context.local_paths.tfrecords_cache_dir)
+    key = cache.linked_key(context.local_paths.subset_tfrecords_dir)
+    with cache.lock(key, shared=True) if key else nullcontext():
+        run_tao([context.config.head, "train",
+                 "--gpus", context.tao.gpus,
+                 "--gpu_index", context.tao.gpu_indices,
+                 "-e", context.docker_paths.compiled_train_spec_file.as_posix(),
+                 "-r", context.docker_paths.model_dir.as_posix(),
+                 "-k", context.config.model_key,
+                 "--log_file", context.docker_paths.model_dir.joinpath("train.log").as_posix()],
+                log_file=context.local_paths.model_dir.joinpath("train.stdout.log"), tail_file=log_file)
@@ -0,0 +1,107 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import monotonic, time
+from typing import Any, Dict, Iterator, Optional
+
+
+class Tracer:
+    """Writes the spans of an invocation as JSON lines to 'file'.
+
+    If 'profile_prefix' is set, profiled() blocks run under cProfile and dump their stats to '<profile_prefix>.<name>.prof'."""
+
+    def __init__(self, file: Path, profile_prefix: Optional[Path] = None):
+        self.file = file
+        self.profile_prefix = profile_prefix
+        self._lock = threading.Lock()
+        file.parent.mkdir(parents=True, exist_ok=True)
+        # Each invocation has its own file (see start_trace)
+        self._stream = open(file, 'x')
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            self._stream.write(line)
+            self._stream.flush()
+
+    def close(self):
+        with self._lock:
+            self._stream.close()
+
+
+# The tracer of the running invocation, None if tracing is off
+_tracer: Optional[Tracer] = None
+
+
+def start_trace(trace_dir: Path, command: str, profile: bool = False) -> Tracer:
+    """Starts tracing to '<trace_dir>/<timestamp>_<command>_<pid>.jsonl'. The pid keeps invocations started in the same
+    second apart."""
+    global _tracer
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{command}_{os.getpid()}"
+    _tracer = Tracer(trace_dir.joinpath(name + '.jsonl'), trace_dir.joinpath(name) if profile else None)
+    return _tracer
+
+
+def stop_trace():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+@contextmanager
+def span(name: str, /, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """Times the block as one record of the trace. The yielded dict can be filled with counters
+    (e.g. 'files', 'bytes'), which are written with the record."""
+    counters: Dict[str, Any] = {}
+    if _tracer is None:
+        yield counters
+        return
+
+    tracer = _tracer
+    start, started = monotonic(), time()
+    error = None
+    try:
+        yield counters
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record = {'span': name, 'job': getattr(sys.stdout, 'current_name', lambda: None)(),
+                  'thread': threading.current_thread().name, 'start': round(started, 3),
+                  'seconds': round(monotonic() - start, 6), **attributes, **counters}
+        if error is not None:
+            record['error'] = error
+        tracer.write(record)
+
+
+@contextmanager
+def profiled(name: str) -> Iterator[None]:
+    """Runs the block under cProfile if profiling is enabled. Only the calling thread is profiled.
+
+    Since Python 3.12, only one profiler can be active per process: blocks starting while another one is profiled
+    (e.g. parallel jobs) run without profile."""
+    tracer = _tracer
+    if tracer is None or tracer.profile_prefix is None:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError as e:
+        print(f"Not profiling {name}: {e}")
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        stats_file = tracer.profile_prefix.with_name(f"{tracer.profile_prefix.name}.{name.replace('/', '_')}.prof")
+        profile.dump_stats(stats_file)
+        print(f"Profile written to {stats_file} (view with 'python -m pstats {stats_file}')")
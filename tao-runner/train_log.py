@@ -0,0 +1,147 @@
+import csv
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Pattern
+
+from .fileutils import write_atomic
+
+STATE_VERSION = 1
+
+# Start of an epoch in the keras output, e.g. 'Epoch 3/80'
+EPOCH_PATTERN = re.compile(rb'Epoch (\d+)/\d+')
+
+# Metric name -> pattern of its value, per head. Heads not listed use 'default'.
+# The first metric marks the end of an epoch, if the log contains no 'Epoch x/y' lines.
+HEAD_PATTERNS: Dict[str, Dict[str, Pattern[bytes]]] = {
+    'default': {
+        # End of epoch, e.g. '1000/1000 [===] - 300s 300ms/step - loss: 1.2345'
+        'loss': re.compile(rb'step - loss: (\d+(?:\.\d*)?(?:e[-+]?\d+)?)'),
+        'mAP': re.compile(rb'mAP(?:@0\.5)? = (\d+(?:\.\d*)?)'),
+    },
+    'faster_rcnn': {
+        'loss': re.compile(rb'step - loss: (\d+(?:\.\d*)?(?:e[-+]?\d+)?)'),
+        'mAP': re.compile(rb'mAP@0\.5 = (\d+(?:\.\d*)?)'),
+    },
+    'detectnet_v2': {
+        # tensorflow logging, e.g. 'loss = 0.0012, step = 1200'
+        'loss': re.compile(rb'loss = (\d+(?:\.\d*)?(?:e[-+]?\d+)?)'),
+        'mAP': re.compile(rb'Mean average_precision \(in %\): (\d+(?:\.\d*)?)'),
+    },
+}
+
+
+def head_patterns(head: str) -> Dict[str, Pattern[bytes]]:
+    return HEAD_PATTERNS.get(head, HEAD_PATTERNS['default'])
+
+
+class MetricsLog:
+    """Per-epoch metrics of a (possibly still growing) train.log.
+
+    The parse state (byte offset, current epoch and the metrics so far) is kept in 'state_file',
+    so each update only reads the part of the log that was appended since the last one."""
+
+    def __init__(self, log_file: Path, state_file: Path, head: str):
+        self.log_file = log_file
+        self.state_file = state_file
+        self.head = head
+        self.patterns = head_patterns(head)
+        self.offset = 0
+        self.inode: Optional[int] = None
+        self.epoch = 0
+        self.epoch_started = False
+        # Epoch -> metric -> value
+        self.epochs: Dict[int, Dict[str, float]] = {}
+        self._load()
+
+    @property
+    def metrics(self) -> List[str]:
+        return list(self.patterns)
+
+    def _load(self):
+        try:
+            state = json.loads(self.state_file.read_bytes())
+        except (OSError, ValueError):
+            return
+        if state.get('version') != STATE_VERSION or state.get('head') != self.head:
+            return
+        self.offset = state['offset']
+        self.inode = state['inode']
+        self.epoch = state['epoch']
+        self.epoch_started = state['epoch_started']
+        self.epochs = {int(epoch): values for epoch, values in state['epochs'].items()}
+
+    def _save(self):
+        write_atomic(self.state_file, json.dumps({
+            'version': STATE_VERSION, 'head': self.head, 'offset': self.offset, 'inode': self.inode,
+            'epoch': self.epoch, 'epoch_started': self.epoch_started, 'epochs': self.epochs
+        }))
+
+    def _reset(self):
+        self.offset = 0
+        self.epoch = 0
+        self.epoch_started = False
+        self.epochs = {}
+
+    def update(self) -> bool:
+        """Parses the lines appended to the log since the last update. Returns whether new lines were parsed."""
+        st = os.stat(self.log_file)
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # A new or truncated log
+            self._reset()
+            self.inode = st.st_ino
+        if st.st_size == self.offset:
+            return False
+
+        with open(self.log_file, 'rb') as r:
+            r.seek(self.offset)
+            for line in r:
+                if not line.endswith(b'\n'):
+                    # Incomplete line, parsed with the next update
+                    break
+                self.offset += len(line)
+                self._parse_line(line)
+
+        self._save()
+        return True
+
+    def _parse_line(self, line: bytes):
+        epoch = None
+        for epoch in EPOCH_PATTERN.finditer(line):
+            pass
+        if epoch is not None:
+            self.epoch = int(epoch.group(1))
+            self.epoch_started = True
+
+        for i, (name, pattern) in enumerate(self.patterns.items()):
+            match = None
+            for match in pattern.finditer(line):
+                pass
+            if match is None:
+                continue
+            if i == 0:
+                if not self.epoch_started:
+                    self.epoch += 1
+                self.epoch_started = False
+            self.epochs.setdefault(max(self.epoch, 1), {})[name] = float(match.group(1))
+
+    def rows(self) -> List[List[Optional[float]]]:
+        """One row per epoch: the epoch followed by the metrics (None if not logged for the epoch)."""
+        return [[epoch] + [self.epochs[epoch].get(name) for name in self.metrics] for epoch in sorted(self.epochs)]
+
+    def write_csv(self, file: Path):
+        with open(file, 'w', newline='') as w:
+            writer = csv.writer(w)
+            writer.writerow(['epoch'] + self.metrics)
+            for row in self.rows():
+                writer.writerow(['' if value is None else value for value in row])
+
+    def write_npy(self, file: Path):
+        """Writes the rows as a float array (NaN for missing values). Requires numpy."""
+        import numpy as np
+
+        array = np.array([[np.nan if value is None else value for value in row] for row in self.rows()],
+                         dtype=np.float64).reshape(-1, len(self.metrics) + 1)
+        with open(file, 'wb') as w:
+            np.save(w, array)